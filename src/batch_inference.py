@@ -0,0 +1,182 @@
+"""
+ Batch inference.
+
+ Streams a query file through beam search one mini-batch at a time and writes the top-k answers of each
+ query, their scores and their explanation paths. Only one mini-batch of queries and predictions is held in
+ memory, whatever the size of the query file.
+
+ Query file: one "e1\tr" query or "e1\te2\tr" triple per line. e2 is only used to mask the ground truth edge.
+ Output formats:
+    jsonl: one {"line": ..., "e1": ..., "r": ..., "predictions": [{"e2": ..., "score": ..., "path": ...}]}
+        object per query.
+    columnar: a directory with a raw little-endian file per column and a meta.json file listing the dtype and
+        shape of each column, so that a column can be loaded with numpy.memmap. Missing predictions and paths
+        are padded with -1 ids and 0 scores.
+"""
+
+import itertools
+import json
+import os
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+import src.utils.ops as ops
+
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+def read_queries(input_path, kg, num_skipped):
+    """
+    Lazily read the queries of a query file. Malformed lines and queries with an unknown source entity or
+    relation are skipped.
+
+    :param num_skipped: Dictionary counting the skipped 'malformed' lines and 'unknown' queries.
+    :return: Generator of the (line number, e1, e2, r) ids of the queries.
+    """
+    with open(input_path, encoding='utf-8') as f:
+        for line_id, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            fields = line.split('\t')
+            if len(fields) == 2:
+                e1, r = fields
+                e2 = None
+            elif len(fields) == 3:
+                e1, e2, r = fields
+            else:
+                num_skipped['malformed'] += 1
+                continue
+            if not e1 in kg.entity2id_aug or not r in kg.relation2id:
+                num_skipped['unknown'] += 1
+                continue
+            e2_id = kg.entity2id_aug.get(e2, kg.dummy_e)
+            yield line_id, kg.entity2id_aug[e1], e2_id, kg.relation2id[r]
+
+
+def get_entity_name(e, kg):
+    return kg.id2entity[e] if e in kg.id2entity else kg.id2entity_aug[e]
+
+
+class JSONLWriter():
+    def __init__(self, output_path, kg):
+        self.kg = kg
+        self.o_f = open(output_path, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE)
+
+    def write(self, queries, predictions):
+        """
+        :param queries: List of (line number, e1, e2, r) ids.
+        :param predictions: List of the top-k (e2, score, path) predictions of each query.
+        """
+        kg = self.kg
+        for (line_id, e1, _, r), query_predictions in zip(queries, predictions):
+            record = {
+                'line': line_id,
+                'e1': get_entity_name(e1, kg),
+                'r': kg.id2relation[r],
+                'predictions': [{
+                    'e2': get_entity_name(e2, kg),
+                    'score': score,
+                    'path': ops.format_path(path, kg)
+                } for e2, score, path in query_predictions]
+            }
+            self.o_f.write(json.dumps(record) + '\n')
+
+    def close(self):
+        self.o_f.close()
+
+
+class ColumnarWriter():
+    """
+    Columns:
+        line: [num_queries] line numbers of the queries in the query file.
+        e1, r: [num_queries] query ids.
+        e2: [num_queries, top_k] predicted entity ids.
+        score: [num_queries, top_k] prediction scores.
+        path_r, path_e: [num_queries, top_k, path_length] relation and entity ids of the paths.
+    """
+    def __init__(self, output_dir, top_k, path_length):
+        self.output_dir = output_dir
+        self.top_k = top_k
+        self.path_length = path_length
+        self.columns = {
+            'line': ('<i8', []),
+            'e1': ('<i8', []),
+            'r': ('<i8', []),
+            'e2': ('<i8', [top_k]),
+            'score': ('<f4', [top_k]),
+            'path_r': ('<i8', [top_k, path_length]),
+            'path_e': ('<i8', [top_k, path_length])
+        }
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        self.files = {name: open(os.path.join(output_dir, '{}.bin'.format(name)), 'wb',
+                                 buffering=WRITE_BUFFER_SIZE) for name in self.columns}
+        self.num_rows = 0
+
+    def write(self, queries, predictions):
+        """
+        :param queries: List of (line number, e1, e2, r) ids.
+        :param predictions: List of the top-k (e2, score, path) predictions of each query.
+        """
+        num_rows = len(queries)
+        line_ids, e1, _, r = zip(*queries)
+        e2 = np.full([num_rows, self.top_k], -1, dtype=np.int64)
+        score = np.zeros([num_rows, self.top_k], dtype=np.float32)
+        path_r = np.full([num_rows, self.top_k, self.path_length], -1, dtype=np.int64)
+        path_e = np.full([num_rows, self.top_k, self.path_length], -1, dtype=np.int64)
+        for i, query_predictions in enumerate(predictions):
+            for j, (e2_ij, score_ij, path) in enumerate(query_predictions):
+                e2[i, j] = e2_ij
+                score[i, j] = score_ij
+                path_r[i, j], path_e[i, j] = zip(*path)
+        values = {'line': line_ids, 'e1': e1, 'r': r, 'e2': e2, 'score': score, 'path_r': path_r, 'path_e': path_e}
+        for name, (dtype, _) in self.columns.items():
+            self.files[name].write(np.asarray(values[name], dtype=dtype).tobytes())
+        self.num_rows += num_rows
+
+    def close(self):
+        for o_f in self.files.values():
+            o_f.close()
+        meta = {
+            'num_rows': self.num_rows,
+            'columns': {name: {'dtype': dtype, 'shape': [self.num_rows] + shape}
+                        for name, (dtype, shape) in self.columns.items()}
+        }
+        with open(os.path.join(self.output_dir, 'meta.json'), 'w') as o_f:
+            json.dump(meta, o_f, indent=4)
+
+
+def run_batch_inference(lf, args):
+    """
+    Write the top-k predictions of the queries in --predict_input to --predict_output.
+
+    :param lf: PolicyGradient model in eval mode, built with --inference and --save_beam_search_paths.
+    :param args: Batch inference options (--predict_input, --predict_output, --predict_output_format and
+        --predict_top_k).
+    """
+    kg = lf.kg
+    if args.predict_output_format == 'jsonl':
+        writer = JSONLWriter(args.predict_output, kg)
+    else:
+        writer = ColumnarWriter(args.predict_output, args.predict_top_k, lf.num_rollout_steps + 1)
+    num_skipped = {'malformed': 0, 'unknown': 0}
+    queries = read_queries(args.predict_input, kg, num_skipped)
+    num_queries = 0
+    try:
+        with torch.no_grad(), tqdm(unit='queries') as progress:
+            while True:
+                mini_batch = list(itertools.islice(queries, lf.batch_size))
+                if not mini_batch:
+                    break
+                predictions = lf.predict_paths([(e1, e2, r) for _, e1, e2, r in mini_batch])
+                writer.write(mini_batch, [x[:args.predict_top_k] for x in predictions])
+                num_queries += len(mini_batch)
+                progress.update(len(mini_batch))
+    finally:
+        writer.close()
+    print('Predictions of {} queries written to {}'.format(num_queries, args.predict_output))
+    print('Skipped {} malformed lines and {} queries with an unknown entity or relation'.format(
+        num_skipped['malformed'], num_skipped['unknown']))
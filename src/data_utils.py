@@ -10,9 +10,11 @@
 """
 
 import collections
+import functools
 import numpy as np
 import os
 import pickle
+import struct
 
 START_RELATION = 'START_RELATION'
 NO_OP_RELATION = 'NO_OP_RELATION'
@@ -26,6 +28,15 @@ NO_OP_RELATION_ID = 2
 DUMMY_ENTITY_ID = 0
 NO_OP_ENTITY_ID = 1
 
+# Binary triple store: a little-endian header (magic, format version, number of triples)
+# followed by a contiguous int32 [num_triples, 3] array of (e1, e2, r) indices
+TRIPLE_STORE_MAGIC = b'KGTS'
+TRIPLE_STORE_VERSION = 1
+TRIPLE_STORE_HEADER = struct.Struct('<4sIQ')
+TRIPLE_STORE_DTYPE = np.dtype('<i4')
+TRIPLE_FILES = ['raw.kb', 'train.triples', 'train.dev.triples', 'train.large.triples', 'train.dev.large.triples',
+                'dev.triples', 'test.triples', 'aux.triples']
+
 
 def check_answer_ratio(examples):
     entity_dict = {}
@@ -80,16 +91,11 @@ def get_train_path(args):
 
     return train_path
 
-def load_seen_entities(adj_list_path, entity_index_path):
+def load_seen_entities(data_dir, entity_index_path):
     _, id2entity = load_index(entity_index_path)
-    with open(adj_list_path, 'rb') as f:
-        adj_list = pickle.load(f)
-    seen_entities = set()
-    for e1 in adj_list:
-        seen_entities.add(id2entity[e1])
-        for r in adj_list[e1]:
-            for e2 in adj_list[e1][r]:
-                seen_entities.add(id2entity[e2])
+    adj_list = CSRAdjacency.load(data_dir)
+    seen_entity_ids = np.union1d(adj_list.get_source_entities(), adj_list.entities)
+    seen_entities = set(id2entity[e] for e in seen_entity_ids.tolist())
     print('{} seen entities loaded...'.format(len(seen_entities)))
     return seen_entities
  
@@ -120,51 +126,48 @@ def load_triples(data_path, entity_index_path, relation_index_path, group_exampl
     """
     Convert triples stored on disc into indices.
     """
-    entity2id, _ = load_index(entity_index_path)
-    relation2id, _ = load_index(relation_index_path)
+    entity2id, id2entity = load_index(entity_index_path)
+    relation2id, id2relation = load_index(relation_index_path)
 
     if 'test.triples' in data_path: # Changes made here
         data_dir = data_path.split('/test.triples')[0]
-        entity2id, _ , _ = load_aux_graph(data_dir)
+        entity2id, id2entity = load_aux_entity_index(data_dir)
 
+    if seen_entities:
+        seen_entity_ids = set(entity2id[e] for e in seen_entities if e in entity2id)
 
-    def triple2ids(e1, e2, r):
-        return entity2id[e1], entity2id[e2], relation2id[r]
+    def get_inv_relation_id(r_id):
+        return relation2id[id2relation[r_id] + '_inv']
 
     triples = []
     if group_examples_by_query:
         triple_dict = {}
-    with open(data_path, encoding='utf-8') as f:
-        num_skipped = 0
-        for line in f:
-            e1, e2, r = line.strip().split()
-            if 'test.triples' not in data_path: # Changes made here
-                if seen_entities and (not e1 in seen_entities or not e2 in seen_entities):
-                    num_skipped += 1
-                    if verbose:
-                        print('Skip triple ({}) with unseen entity: {}'.format(num_skipped, line.strip()))
-                    continue
-            # if r in ['concept:agentbelongstoorganization', 'concept:teamplaysinleague']:
-            #     continue
-            if group_examples_by_query:
-                e1_id, e2_id, r_id = triple2ids(e1, e2, r)
-                if e1_id not in triple_dict:
-                    triple_dict[e1_id] = {}
-                if r_id not in triple_dict[e1_id]:
-                    triple_dict[e1_id][r_id] = set()
-                triple_dict[e1_id][r_id].add(e2_id)
-                if add_reverse_relations:
-                    r_inv = r + '_inv'
-                    e2_id, e1_id, r_inv_id = triple2ids(e2, e1, r_inv)
-                    if e2_id not in triple_dict:
-                        triple_dict[e2_id] = {}
-                    if r_inv_id not in triple_dict[e2_id]:
-                        triple_dict[e2_id][r_inv_id] = set()
-                    triple_dict[e2_id][r_inv_id].add(e1_id)
-            else:
-                triples.append(triple2ids(e1, e2, r))
-                if add_reverse_relations:
-                    triples.append(triple2ids(e2, e1, r + '_inv'))
+    num_skipped = 0
+    for e1_id, e2_id, r_id in load_triple_ids(data_path, entity2id, relation2id).tolist():
+        if 'test.triples' not in data_path: # Changes made here
+            if seen_entities and (not e1_id in seen_entity_ids or not e2_id in seen_entity_ids):
+                num_skipped += 1
+                if verbose:
+                    print('Skip triple ({}) with unseen entity: {}\t{}\t{}'.format(
+                        num_skipped, id2entity[e1_id], id2entity[e2_id], id2relation[r_id]))
+                continue
+        if group_examples_by_query:
+            if e1_id not in triple_dict:
+                triple_dict[e1_id] = {}
+            if r_id not in triple_dict[e1_id]:
+                triple_dict[e1_id][r_id] = set()
+            triple_dict[e1_id][r_id].add(e2_id)
+            if add_reverse_relations:
+                r_inv_id = get_inv_relation_id(r_id)
+                if e2_id not in triple_dict:
+                    triple_dict[e2_id] = {}
+                if r_inv_id not in triple_dict[e2_id]:
+                    triple_dict[e2_id][r_inv_id] = set()
+                triple_dict[e2_id][r_inv_id].add(e1_id)
+        else:
+            triples.append((e1_id, e2_id, r_id))
+            if add_reverse_relations:
+                triples.append((e2_id, e1_id, get_inv_relation_id(r_id)))
     if group_examples_by_query:
         for e1_id in triple_dict:
             for r_id in triple_dict[e1_id]:
@@ -189,52 +192,306 @@ def load_index(input_path):
             rev_index[i] = v
     return index, rev_index
 
+def load_page_rank_scores(input_path, entity2id, num_entities=None):
+    """
+    Load the PageRank scores of the entities in entity2id.
+    :return: float64 numpy array of PageRank scores indexed by entity id (0 for entities without a score).
+    """
+    if num_entities is None:
+        num_entities = len(entity2id)
+    pgrk_scores = np.zeros(num_entities)
+    with open(input_path, encoding='utf-8') as f:
+        for line in f:
+            e, score = line.strip().split(':')
+            e = e.strip()
+            if e in entity2id:
+                pgrk_scores[entity2id[e]] = float(score)
+    return pgrk_scores
 
-def load_aux_graph(data_dir): # Changes made here
+def is_up_to_date(output_path, *input_paths):
+    """
+    Check if output_path exists and is not older than any of the existing input_paths.
+    """
+    if not os.path.exists(output_path):
+        return False
+    mtime = os.path.getmtime(output_path)
+    return all(os.path.getmtime(p) <= mtime for p in input_paths if os.path.exists(p))
+
+def get_triple_store_path(data_path):
+    return data_path + '.bin'
+
+def save_triple_store(triples, output_path):
+    """
+    Save an integer [num_triples, 3] array of (e1, e2, r) indices in the binary triple store format.
+    """
+    triples = np.ascontiguousarray(triples, dtype=TRIPLE_STORE_DTYPE).reshape(-1, 3)
+    with open(output_path, 'wb') as o_f:
+        o_f.write(TRIPLE_STORE_HEADER.pack(TRIPLE_STORE_MAGIC, TRIPLE_STORE_VERSION, len(triples)))
+        o_f.write(triples.tobytes())
+
+def load_triple_store(data_path):
+    """
+    Memory-map the binary triple store of a triple file.
+
+    :param data_path: Path to the text triple file.
+    :return: read-only int32 [num_triples, 3] array of (e1, e2, r) indices, or None if the store does
+        not exist, is out of date or was written in a different format version.
+    """
+    store_path = get_triple_store_path(data_path)
+    data_dir = os.path.dirname(data_path)
+    # the ids of unseen entities come from the aux entity index, built from aux.triples and test.triples
+    dependencies = [os.path.join(data_dir, file_name) for file_name in
+                    ['entity2id.txt', 'relation2id.txt', 'entity2id_aug.txt', 'aux.triples', 'test.triples']]
+    if not is_up_to_date(store_path, data_path, *dependencies):
+        return None
+    with open(store_path, 'rb') as f:
+        header = f.read(TRIPLE_STORE_HEADER.size)
+    if len(header) < TRIPLE_STORE_HEADER.size:
+        return None
+    magic, version, num_triples = TRIPLE_STORE_HEADER.unpack(header)
+    if magic != TRIPLE_STORE_MAGIC or version != TRIPLE_STORE_VERSION:
+        print('Ignoring triple store {} (version {}, expected {})'.format(store_path, version, TRIPLE_STORE_VERSION))
+        return None
+    if num_triples == 0:
+        return np.zeros((0, 3), dtype=TRIPLE_STORE_DTYPE)
+    return np.memmap(store_path, dtype=TRIPLE_STORE_DTYPE, mode='r', offset=TRIPLE_STORE_HEADER.size,
+                     shape=(num_triples, 3))
+
+def parse_triples(data_path, entity2id, relation2id):
+    triples = []
+    with open(data_path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            e1, e2, r = line.split()
+            triples.append((entity2id[e1], entity2id[e2], relation2id[r]))
+    return np.array(triples, dtype=TRIPLE_STORE_DTYPE).reshape(-1, 3)
+
+def load_triple_ids(data_path, entity2id, relation2id):
+    """
+    Load the triples of a file as an int32 [num_triples, 3] array of (e1, e2, r) indices. The binary
+    triple store written by --process_data is used if available, otherwise the text file is parsed.
+
+    Entities of the store are indexed in the augmented (seen + unseen) entity space, which agrees with
+    the seen entity index on all seen entities.
+    """
+    triples = load_triple_store(data_path)
+    if triples is None:
+        triples = parse_triples(data_path, entity2id, relation2id)
+    return triples
+
+def load_aux_entity_index(data_dir):
+    """
+    Load the augmented entity index: the seen entities followed by the unseen entities in the order
+    they first appear in aux.triples and test.triples.
+    """
+    aux_index_path = os.path.join(data_dir, 'entity2id_aug.txt')
+    if is_up_to_date(aux_index_path, os.path.join(data_dir, 'entity2id.txt'),
+                     os.path.join(data_dir, 'aux.triples'), os.path.join(data_dir, 'test.triples')):
+        return load_index(aux_index_path)
+    return build_aux_entity_index(data_dir)
+
+def build_aux_entity_index(data_dir):
     entity2id, id2entity = load_index(os.path.join(data_dir, 'entity2id.txt'))
-    relation2id, id2relation = load_index(os.path.join(data_dir, 'relation2id.txt'))
-    seen_entity2id = entity2id.copy()
+    for triple_path in [os.path.join(data_dir, 'aux.triples'), os.path.join(data_dir, 'test.triples')]:
+        if not os.path.exists(triple_path):
+            continue
+        with open(triple_path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                e1, e2, _ = line.split()
+                add_entities(entity2id, id2entity, (e1, e2))
+    return entity2id, id2entity
+
+def add_entities(entity2id, id2entity, entities):
+    """
+    Index the entities that are not in entity2id yet, in order, after the indexed entities.
+    :return: Number of entities added.
+    """
+    num_entities = len(entity2id)
+    for e in entities:
+        if e not in entity2id:
+            e_id = len(entity2id)
+            entity2id[e] = e_id
+            id2entity[e_id] = e
+    return len(entity2id) - num_entities
+
+def save_triple_stores(data_dir, entity2id, relation2id):
+    """
+    Write the binary triple store of every triple file in data_dir.
+    """
+    for file_name in TRIPLE_FILES:
+        data_path = os.path.join(data_dir, file_name)
+        if not os.path.exists(data_path):
+            continue
+        try:
+            triples = parse_triples(data_path, entity2id, relation2id)
+        except KeyError as e:
+            print('Skip triple store of {}: {} is not indexed'.format(data_path, e))
+            continue
+        save_triple_store(triples, get_triple_store_path(data_path))
+        print('{} triples saved to {}'.format(len(triples), get_triple_store_path(data_path)))
+
+
+class CSRAdjacency():
+    """
+    Array-backed adjacency list of the KG environment in compressed sparse row (CSR) format.
 
-    adj_list_path = os.path.join(data_dir, 'adj_list.pkl')
-    with open(adj_list_path, 'rb') as f:
-        adj_list = pickle.load(f)
+    The facts of entity e1 are (e1, relations[i], entities[i]) for offsets[e1] <= i < offsets[e1 + 1]. They
+    are kept in the order of the former {e1: {r: set(e2)}} adjacency dictionary: grouped by relation in
+    the order each relation first appears for e1, then by target entity in input order. Each fact is stored
+    once.
+    """
+    file_names = ['adj_list.offsets.npy', 'adj_list.relations.npy', 'adj_list.entities.npy']
+
+    def __init__(self, offsets, relations, entities):
+        self.offsets = offsets
+        self.relations = relations
+        self.entities = entities
+
+    @classmethod
+    def from_edges(cls, e1, r, e2, num_nodes):
+        """
+        :param e1, r, e2: integer arrays of fact subjects, relations and objects (may contain duplicates).
+            Only the first occurrence of a fact is kept.
+        :param num_nodes: number of entities.
+        """
+        e1 = np.asarray(e1, dtype=np.int64).reshape(-1)
+        r = np.asarray(r, dtype=np.int64).reshape(-1)
+        e2 = np.asarray(e2, dtype=np.int64).reshape(-1)
+        assert(len(e1) == 0 or e1.max() < num_nodes)
+        num_relations = int(r.max()) + 1 if len(r) > 0 else 1
+        num_targets = max(int(e2.max()) + 1 if len(e2) > 0 else 1, num_nodes)
+        query_keys = e1 * num_relations + r
+        _, first_fact_ids = np.unique(query_keys * num_targets + e2, return_index=True)
+        is_unique = np.zeros(len(e1), dtype=bool)
+        is_unique[first_fact_ids] = True
+        e1, r, e2, query_keys = e1[is_unique], r[is_unique], e2[is_unique], query_keys[is_unique]
+        # position of the first fact of every (e1, r) group
+        _, first_query_ids, query_ids = np.unique(query_keys, return_index=True, return_inverse=True)
+        order = np.lexsort((np.arange(len(e1)), first_query_ids[query_ids], e1))
+        e1, r, e2 = e1[order], r[order], e2[order]
+        offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(e1, minlength=num_nodes), out=offsets[1:])
+        return cls(offsets, r.astype(np.int32), e2.astype(np.int32))
+
+    @classmethod
+    def from_adj_list(cls, adj_list, num_nodes):
+        """
+        Convert an adjacency list of the form {e1: {r: set(e2)}}.
+        """
+        e1_ids, r_ids, e2_ids = [], [], []
+        for e1 in adj_list:
+            for r in adj_list[e1]:
+                for e2 in adj_list[e1][r]:
+                    e1_ids.append(e1)
+                    r_ids.append(r)
+                    e2_ids.append(e2)
+        return cls.from_edges(e1_ids, r_ids, e2_ids, num_nodes)
+
+    @classmethod
+    def load(cls, data_dir):
+        """
+        Memory-map the adjacency saved in data_dir. Data processed before the CSR format was introduced
+        is read from adj_list.pkl.
+        """
+        paths = [os.path.join(data_dir, file_name) for file_name in cls.file_names]
+        if all(os.path.exists(path) for path in paths):
+            return cls(*[np.load(path, mmap_mode='r') for path in paths])
+        entity2id, _ = load_index(os.path.join(data_dir, 'entity2id.txt'))
+        with open(os.path.join(data_dir, 'adj_list.pkl'), 'rb') as f:
+            return cls.from_adj_list(pickle.load(f), len(entity2id))
+
+    def save(self, data_dir):
+        for file_name, array in zip(self.file_names, [self.offsets, self.relations, self.entities]):
+            np.save(os.path.join(data_dir, file_name), array)
+
+    @property
+    def num_nodes(self):
+        return len(self.offsets) - 1
+
+    @property
+    def num_facts(self):
+        return len(self.relations)
+
+    def __contains__(self, e1):
+        return 0 <= e1 < self.num_nodes and self.offsets[e1 + 1] > self.offsets[e1]
+
+    def get_degrees(self):
+        return np.diff(self.offsets)
+
+    def get_source_entities(self):
+        """
+        :return: sorted array of the entities with at least one fact.
+        """
+        return np.nonzero(self.get_degrees())[0]
+
+    def get_neighbors(self, e1):
+        """
+        :return r, e2: the relations and objects of the facts of e1.
+        """
+        start, end = self.offsets[e1], self.offsets[e1 + 1]
+        return self.relations[start:end], self.entities[start:end]
+
+    def get_unique_relations(self, e1):
+        r, _ = self.get_neighbors(e1)
+        if len(r) == 0:
+            return r
+        return r[np.concatenate([[True], r[1:] != r[:-1]])]
+
+    def get_edges(self):
+        """
+        :return e1, r, e2: arrays of all fact subjects, relations and objects.
+        """
+        e1 = np.repeat(np.arange(self.num_nodes, dtype=np.int64), self.get_degrees())
+        return e1, np.asarray(self.relations), np.asarray(self.entities)
+
+    def add_edges(self, e1, r, e2, num_nodes=None):
+        """
+        :return: a new adjacency with the facts (e1, r, e2) added, optionally extended to num_nodes entities.
+        """
+        num_nodes = self.num_nodes if num_nodes is None else max(num_nodes, self.num_nodes)
+        src, rel, dst = self.get_edges()
+        return CSRAdjacency.from_edges(np.concatenate([src, np.asarray(e1, dtype=np.int64)]),
+                                       np.concatenate([rel, np.asarray(r, dtype=np.int64)]),
+                                       np.concatenate([dst, np.asarray(e2, dtype=np.int64)]), num_nodes)
 
-    with open(os.path.join(data_dir, 'aux.triples'), encoding='utf-8') as f:
-        for i, line in enumerate(f.readlines()):
-            e1, e2, r = line.strip().split('\t')
 
-            if e1 not in entity2id:
-                e1_id = len(entity2id)
-                entity2id[e1] = e1_id
-                id2entity[e1_id] = e1
-
-            if e2 not in entity2id:
-                e2_id = len(entity2id)
-                entity2id[e2] = e2_id
-                id2entity[e2_id] = e2
-
-            if e1 in seen_entity2id and e2 not in seen_entity2id :
-                e1_id = entity2id[e1]
-                r_inv_id = relation2id[r + '_inv']
-                e2_id = entity2id[e2]
-                if e2_id not in adj_list:
-                    adj_list[e2_id] = collections.defaultdict()
-                if r_inv_id not in adj_list[e2_id]:
-                    adj_list[e2_id][r_inv_id] = set()
-                adj_list[e2_id][r_inv_id].add(e1_id)
-
-            if e2 in seen_entity2id and e1 not in seen_entity2id:
-                e1_id = entity2id[e1]
-                r_id = relation2id[r]
-                e2_id = entity2id[e2]
-                if e1_id not in adj_list:
-                    adj_list[e1_id] = collections.defaultdict()
-                if r_id not in adj_list[e1_id]:
-                    adj_list[e1_id][r_id] = set()
-                adj_list[e1_id][r_id].add(e2_id)
+def load_aux_graph(data_dir): # Changes made here
+    relation2id, id2relation = load_index(os.path.join(data_dir, 'relation2id.txt'))
+    seen_entity2id, _ = load_index(os.path.join(data_dir, 'entity2id.txt'))
+    # Unseen entities are indexed after the seen entities
+    entity2id, id2entity = load_aux_entity_index(data_dir)
+
+    aux_triples = load_triple_ids(os.path.join(data_dir, 'aux.triples'), entity2id, relation2id)
+    adj_list = add_aux_edges(CSRAdjacency.load(data_dir), aux_triples, len(seen_entity2id), len(entity2id),
+                             relation2id, id2relation)
 
     return entity2id, id2entity, adj_list
 
+def add_aux_edges(adj_list, aux_triples, num_seen_entities, num_entities, relation2id, id2relation):
+    """
+    Connect the unseen entities of the aux triples to the seen entities they are linked to.
+    :param aux_triples: [num_triples, 3] array of (e1, e2, r) ids in the augmented entity index.
+    :param num_seen_entities: Number of seen entities, indexed before the unseen entities.
+    :param num_entities: Number of seen and unseen entities.
+    :return: a new adjacency with the edges from the unseen entities added.
+    """
+    aux_triples = np.asarray(aux_triples, dtype=np.int64).reshape(-1, 3)
+    e1, e2, r = aux_triples[:, 0], aux_triples[:, 1], aux_triples[:, 2]
+    inv_relation_ids = np.array([relation2id.get(id2relation[r_id] + '_inv', -1)
+                                 for r_id in range(len(relation2id))], dtype=np.int64)
+    to_e2 = (e1 < num_seen_entities) & (e2 >= num_seen_entities)
+    to_e1 = (e2 < num_seen_entities) & (e1 >= num_seen_entities)
+    return adj_list.add_edges(
+        np.concatenate([e2[to_e2], e1[to_e1]]),
+        np.concatenate([inv_relation_ids[r[to_e2]], r[to_e1]]),
+        np.concatenate([e1[to_e2], e2[to_e1]]),
+        num_nodes=num_entities)
+
 
 def prepare_kb_envrioment(raw_kb_path, train_path, dev_path, test_path, aux_path, test_mode, add_reverse_relations=True):
     """
@@ -327,9 +584,8 @@ def prepare_kb_envrioment(raw_kb_path, train_path, dev_path, test_path, aux_path
     type2id, id2type = load_index(os.path.join(data_dir, 'type2id.txt'))
 
     removed_triples = set(removed_triples)
-    adj_list = collections.defaultdict(collections.defaultdict)
     entity2typeid = [0 for i in range(len(entity2id))]
-    num_facts = 0
+    e1_ids, r_ids, e2_ids = [], [], []
     for line in set(raw_kb_triples + keep_triples):
         e1, e2, r = line.strip().split()
         triple_signature = '{}\t{}\t{}'.format(e1, e2, r)
@@ -342,33 +598,38 @@ def prepare_kb_envrioment(raw_kb_path, train_path, dev_path, test_path, aux_path
         entity2typeid[e1_id] = t1_id
         entity2typeid[e2_id] = t2_id
         if not triple_signature in removed_triples:
-            r_id = relation2id[r]
-            if not r_id in adj_list[e1_id]:
-                adj_list[e1_id][r_id] = set()
-            if e2_id in adj_list[e1_id][r_id]:
-                print('Duplicate fact: {} ({}, {}, {})!'.format(
-                    line.strip(), id2entity[e1_id], id2relation[r_id], id2entity[e2_id]))
-            adj_list[e1_id][r_id].add(e2_id)
-            num_facts += 1
+            e1_ids.append(e1_id)
+            r_ids.append(relation2id[r])
+            e2_ids.append(e2_id)
             if add_reverse_relations:
-                inv_r = r + '_inv'
-                inv_r_id = relation2id[inv_r]
-                if not inv_r_id in adj_list[e2_id]:
-                    adj_list[e2_id][inv_r_id] = set([])
-                if e1_id in adj_list[e2_id][inv_r_id]:
-                    print('Duplicate fact: {} ({}, {}, {})!'.format(
-                        line.strip(), id2entity[e2_id], id2relation[inv_r_id], id2entity[e1_id]))
-                adj_list[e2_id][inv_r_id].add(e1_id)
-                num_facts += 1
-    print('{} facts processed'.format(num_facts))
+                e1_ids.append(e2_id)
+                r_ids.append(relation2id[r + '_inv'])
+                e2_ids.append(e1_id)
+    print('{} facts processed'.format(len(e1_ids)))
     # Save adjacency list
-    adj_list_path = os.path.join(data_dir, 'adj_list.pkl')
-    with open(adj_list_path, 'wb') as o_f:
-        pickle.dump(dict(adj_list), o_f)
+    adj_list = CSRAdjacency.from_edges(e1_ids, r_ids, e2_ids, len(entity2id))
+    if adj_list.num_facts < len(e1_ids):
+        print('{} duplicate facts removed'.format(len(e1_ids) - adj_list.num_facts))
+    adj_list.save(data_dir)
     with open(os.path.join(data_dir, 'entity2typeid.pkl'), 'wb') as o_f:
         pickle.dump(entity2typeid, o_f)
 
+    # Save the augmented entity index (seen entities followed by the unseen entities of the aux and test sets)
+    entity2id_aug, id2entity_aug = build_aux_entity_index(data_dir)
+    with open(os.path.join(data_dir, 'entity2id_aug.txt'), 'w', encoding='utf-8') as o_f:
+        for e_id in range(len(id2entity_aug)):
+            o_f.write('{}\t{}\n'.format(id2entity_aug[e_id], e_id))
+    print('{} unseen entities indexed'.format(len(entity2id_aug) - len(entity2id)))
+
+    # Save the binary triple stores
+    save_triple_stores(data_dir, entity2id_aug, relation2id)
+
+@functools.lru_cache(maxsize=None)
 def get_seen_queries(data_dir, entity_index_path, relation_index_path):
+    """
+    Split the dev queries by whether the (e1, r) query occurs in the training set. The result is cached
+    per dataset and must not be modified.
+    """
     entity2id, _ = load_index(entity_index_path)
     relation2id, _ = load_index(relation_index_path)
     seen_queries = set()
@@ -401,7 +662,12 @@ def get_seen_queries(data_dir, entity_index_path, relation_index_path):
 
     return seen_queries, (seen_ratio, unseen_ratio)
 
+@functools.lru_cache(maxsize=None)
 def get_relations_by_type(data_dir, relation_index_path):
+    """
+    Split the dev relations into to-M and to-1 relations by their average number of answers per query. The
+    result is cached per dataset and must not be modified.
+    """
     with open(os.path.join(data_dir, 'raw.kb'), encoding='utf-8') as f:
         triples = list(f.readlines())
     if 'NELL' in data_dir:
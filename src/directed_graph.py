@@ -7,6 +7,183 @@ For full license text, see the LICENSE file in the repo root or https://opensour
 
 import os
 
+import numpy as np
+import torch
+import torch.cuda as cuda
+
+from src.data_utils import add_entities, load_aux_entity_index, load_page_rank_scores, load_triple_ids
+from src.data_utils import DUMMY_ENTITY_ID, NO_OP_RELATION_ID
+
+device = torch.device("cuda" if cuda.is_available() else "cpu")
+
+
+class CSRGraph():
+    """
+    Compressed sparse row (CSR) representation of a directed graph.
+
+    The neighbors of entity e1 are stored contiguously: (relations[i], entities[i]) for
+    offsets[e1] <= i < offsets[e1 + 1], sorted by relation and then in the order the edges are given.
+    The edges of an entity labeled by a query relation q or its inverse q + 1 therefore form a single
+    range, located by binary search on the (entity, relation) keys.
+    """
+    def __init__(self, e1, r, e2, num_nodes, neighbor_scores=None):
+        """
+        :param e1: numpy array of edge source entities.
+        :param r: numpy array of edge relations.
+        :param e2: numpy array of edge target entities.
+        :param num_nodes: number of entities in the graph.
+        :param neighbor_scores: numpy array of entity scores (PageRank) used by get_top_neighbors.
+        """
+        order = np.lexsort((r, e1))
+        degrees = np.bincount(e1, minlength=num_nodes)
+        self.num_nodes = num_nodes
+        self.num_edges = len(e1)
+        # key base of the (entity, relation) keys: relations are 0 <= r < num_relations
+        self.num_relations = int(r.max()) + 1 if len(r) > 0 else 1
+        self.offsets = torch.from_numpy(np.concatenate([[0], np.cumsum(degrees)]).astype(np.int64)).to(device)
+        self.relations = torch.from_numpy(r[order].astype(np.int64)).to(device)
+        self.entities = torch.from_numpy(e2[order].astype(np.int64)).to(device)
+        # sorted entity * (num_relations + 1) + relation key of every edge
+        self.edge_keys = torch.from_numpy(
+            e1[order].astype(np.int64) * (self.num_relations + 1) + r[order].astype(np.int64)).to(device)
+        self.neighbor_scores = neighbor_scores
+        # num_neighbors => (sorted selection keys, [num_selections, num_neighbors] edge ids)
+        self.top_neighbors = {}
+
+    def __getitem__(self, e1):
+        start, end = self.offsets[e1].item(), self.offsets[e1 + 1].item()
+        return list(zip(self.relations[start:end].tolist(), self.entities[start:end].tolist()))
+
+    def get_edges(self):
+        """
+        :return e1, r, e2: numpy arrays of the edges in CSR order.
+        """
+        offsets = self.offsets.cpu().numpy()
+        e1 = np.repeat(np.arange(self.num_nodes), offsets[1:] - offsets[:-1])
+        return e1, self.relations.cpu().numpy(), self.entities.cpu().numpy()
+
+    def get_excluded_range(self, e1, q):
+        """
+        :param e1: (Variable:batch) entity indices.
+        :param q: (Variable:batch) query relation indices.
+        :return lo, hi: (Variable:batch) edge range [lo, hi) of each entity labeled by q or q + 1.
+        """
+        key_base = self.num_relations + 1
+        q = q.clamp(min=0, max=self.num_relations)
+        lo = torch.searchsorted(self.edge_keys, e1 * key_base + q)
+        hi = torch.searchsorted(self.edge_keys, e1 * key_base + (q + 2).clamp(max=key_base))
+        return lo, hi
+
+    def get_neighbor_edge_ids(self, e1, q, width=None):
+        """
+        Edge ids of the neighbors of a batch of entities, skipping the range labeled by the query relation
+        or its inverse.
+        :param e1: (Variable:batch) entity indices.
+        :param q: (Variable:batch) query relation indices.
+        :param width: Number of columns returned (the maximum number of neighbors if None).
+        :return edge_ids: [batch_size, width] edge ids (0 at the masked positions).
+        :return mask: [batch_size, width] binary mask indicating the valid neighbors.
+        :return degree: (Variable:batch) number of neighbors of each entity.
+        """
+        start = self.offsets[e1]
+        lo, hi = self.get_excluded_range(e1, q)
+        num_excluded = hi - lo
+        degree = self.offsets[e1 + 1] - start - num_excluded
+        if width is None:
+            width = max(int(degree.max()), 1)
+        column = torch.arange(width, device=e1.device).unsqueeze(0)
+        mask = column < degree.unsqueeze(1)
+        edge_ids = start.unsqueeze(1) + column
+        edge_ids = edge_ids + num_excluded.unsqueeze(1) * (edge_ids >= lo.unsqueeze(1)).long()
+        # padding positions point at the first edge of the graph and are masked out
+        return edge_ids * mask.long(), mask, degree
+
+    def get_neighbors(self, e1, q):
+        """
+        Gather the neighbors of a batch of entities, excluding the edges labeled by the query
+        relation or its inverse.
+        :param e1: (Variable:batch) entity indices.
+        :param q: (Variable:batch) query relation indices.
+        :return (r, e2): [batch_size, max_degree] neighbor relation and entity indices.
+        :return mask: [batch_size, max_degree] binary mask indicating the valid neighbors.
+        """
+        edge_ids, mask, _ = self.get_neighbor_edge_ids(e1, q)
+        return (self.relations[edge_ids], self.entities[edge_ids]), mask
+
+    def get_top_neighbors(self, e1, q, num_neighbors):
+        """
+        Deterministic version of get_neighbors that keeps at most num_neighbors neighbors per entity: the
+        ones with the highest neighbor scores among the edges not labeled by the query relation or its
+        inverse. The selections are precomputed (see build_top_neighbors), so this is a lookup and a gather.
+        :param e1: (Variable:batch) entity indices.
+        :param q: (Variable:batch) query relation indices.
+        :param num_neighbors: Maximum number of neighbors.
+        :return (r, e2): [batch_size, num_neighbors] neighbor relation and entity indices.
+        :return mask: [batch_size, num_neighbors] binary mask indicating the valid neighbors.
+        """
+        if not num_neighbors in self.top_neighbors:
+            self.top_neighbors[num_neighbors] = self.build_top_neighbors(num_neighbors)
+        selection_keys, selections = self.top_neighbors[num_neighbors]
+
+        # entities with at most num_neighbors edges keep all of them
+        edge_ids, mask, _ = self.get_neighbor_edge_ids(e1, q, width=num_neighbors)
+        is_hub = (self.offsets[e1 + 1] - self.offsets[e1]) > num_neighbors
+        if bool(is_hub.any()):
+            key_base = self.num_relations + 1
+            hub_e1, hub_q = e1[is_hub], q[is_hub]
+            # queries whose relations do not label any edge of the entity use the selection without exclusion
+            default_pos = torch.searchsorted(selection_keys, hub_e1 * key_base)
+            q_keys = hub_e1 * key_base + (hub_q + 1).masked_fill(hub_q >= self.num_relations, 0)
+            pos = torch.searchsorted(selection_keys, q_keys).clamp(max=len(selection_keys) - 1)
+            pos = torch.where(selection_keys[pos] == q_keys, pos, default_pos)
+            hub_edge_ids = selections[pos].long()
+            mask[is_hub] = (hub_edge_ids >= 0)
+            edge_ids[is_hub] = hub_edge_ids * mask[is_hub].long()
+        return (self.relations[edge_ids], self.entities[edge_ids]), mask
+
+    def build_top_neighbors(self, num_neighbors):
+        """
+        Precompute the top num_neighbors edges by neighbor score of every entity with more edges than that,
+        for every set of excluded edges: none, and the edges labeled q or q + 1 for every query q that
+        labels one of them.
+        The selections take 4 * num_neighbors bytes for each entity with more than num_neighbors edges and
+        each query relation (or inverse) labeling one of its edges, plus one selection per such entity.
+        :return selection_keys: sorted entity * (num_relations + 1) + (q + 1 or 0 for no exclusion) keys.
+        :return selections: [len(selection_keys), num_neighbors] int32 edge ids, padded with -1.
+        """
+        assert (self.neighbor_scores is not None)
+        assert (len(self.entities) < 2 ** 31)
+        offsets = self.offsets.cpu().numpy()
+        relations = self.relations.cpu().numpy()
+        entities = self.entities.cpu().numpy()
+        degrees = offsets[1:] - offsets[:-1]
+        key_base = self.num_relations + 1
+
+        selection_keys, selections = [], []
+
+        def add_selection(key, edge_ids):
+            selection = np.full(num_neighbors, -1, dtype=np.int32)
+            selection[:min(len(edge_ids), num_neighbors)] = edge_ids[:num_neighbors]
+            selection_keys.append(key)
+            selections.append(selection)
+
+        for e1 in np.nonzero(degrees > num_neighbors)[0]:
+            edge_ids = np.arange(offsets[e1], offsets[e1 + 1])
+            edge_ids = edge_ids[np.argsort(-self.neighbor_scores[entities[edge_ids]], kind='stable')]
+            r = relations[edge_ids]
+            add_selection(e1 * key_base, edge_ids)
+            for q in np.unique(np.concatenate([r, r - 1])):
+                if 0 <= q < self.num_relations:
+                    add_selection(e1 * key_base + q + 1, edge_ids[(r != q) & (r != q + 1)])
+
+        if not selection_keys:
+            add_selection(-1, np.zeros(0, dtype=np.int64))
+        order = np.argsort(selection_keys)
+        selection_keys = torch.from_numpy(np.array(selection_keys, dtype=np.int64)[order]).to(device)
+        selections = torch.from_numpy(np.stack(selections)[order]).to(device)
+        return selection_keys, selections
+
+
 class Concept2Index():
     def __init__(self, data_dir):
         self.entity2id = {}
@@ -89,9 +266,14 @@ class DirectedGraph(Concept2Index):
         Concept2Index.__init__(self, data_dir)
         self.seen_entity2id = self.entity2id.copy()
         self.seen_id2entity = self.id2entity.copy()
-        self.training_graph = {}
-        self.eval_graph = {}
-        self.aux_graph = {}
+        # Unseen entities of the aux and test sets are indexed after the seen entities
+        self.entity2id, self.id2entity = load_aux_entity_index(data_dir)
+        # [num_aug_entities] mask of the seen entities in the augmented entity index
+        self.is_seen_entity = torch.zeros(len(self.entity2id), dtype=torch.bool)
+        self.is_seen_entity[torch.LongTensor(list(self.seen_id2entity.keys()))] = True
+        self.is_seen_entity = self.is_seen_entity.to(device)
+        self.inv_rel_ids = np.array([self.rel2id.get(self.id2rel[r_id] + '_inv', -1)
+                                     for r_id in range(self.num_relations)], dtype=np.int64)
 
         self.data_files = [os.path.join(data_dir, 'train.triples'), os.path.join(data_dir, 'dev.triples')]
         if 'NELL' in data_dir:
@@ -100,80 +282,98 @@ class DirectedGraph(Concept2Index):
             else:
                 self.data_files = [os.path.join(data_dir, 'train.triples'), os.path.join(data_dir, 'train.large.triples'), os.path.join(data_dir, 'dev.triples')]
 
+        train_triples, all_triples = [], []
         for data_file in self.data_files:
-            with open(data_file, encoding='utf-8') as f:
-                self.data = f.readlines()
-                for triple in self.data:
-                    triple = triple.replace("\r", '').replace('\n', '')
-                    e1, e2, r = triple.split('\t')
-                    r_inv = r + '_inv'
-                    e1_id = self.entity2id[e1]
-                    e2_id = self.entity2id[e2]
-                    r_id = self.rel2id[r]
-                    r_inv_id = self.rel2id[r_inv]
+            triples = load_triple_ids(data_file, self.entity2id, self.rel2id)
+            all_triples.append(triples)
+            if 'train' in data_file:
+                train_triples.append(triples)
 
-                    # Build the directed KG
-                    if e1_id not in self.eval_graph:
-                        self.eval_graph[e1_id] = []
-                    self.eval_graph[e1_id].append([r_id, e2_id])
+        num_nodes = len(self.entity2id)
+        page_rank_scores = load_page_rank_scores(os.path.join(data_dir, 'raw.pgrk'), self.entity2id, num_nodes)
+        eval_edges = self.get_edges(all_triples)
+        self.training_graph = CSRGraph(*self.get_edges(train_triples), num_nodes)
+        self.eval_graph = CSRGraph(*eval_edges, num_nodes, neighbor_scores=page_rank_scores)
+        self.aux_graph = CSRGraph(*self.get_aux_edges(data_dir, eval_edges), num_nodes,
+                                  neighbor_scores=page_rank_scores)
 
-                    if e2_id not in self.eval_graph:
-                        self.eval_graph[e2_id] = []
-                    self.eval_graph[e2_id].append([r_inv_id, e1_id])
+    def get_edges(self, triples_list):
+        """
+        Convert triples into directed edges: each triple (e1, e2, r) adds the edge (e1, r, e2) and its
+        inverse (e2, r_inv, e1). The dummy entity is only connected to itself.
+        :return e1, r, e2: numpy arrays of edge sources, relations and targets.
+        """
+        triples = np.concatenate(triples_list).astype(np.int64)
+        e1, e2, r = triples[:, 0], triples[:, 1], triples[:, 2]
+        src = np.stack([e1, e2], axis=1).reshape(-1)
+        rel = np.stack([r, self.inv_rel_ids[r]], axis=1).reshape(-1)
+        dst = np.stack([e2, e1], axis=1).reshape(-1)
+        keep = (src != DUMMY_ENTITY_ID)
+        src = np.concatenate([[DUMMY_ENTITY_ID], src[keep]])
+        rel = np.concatenate([[NO_OP_RELATION_ID], rel[keep]])
+        dst = np.concatenate([[DUMMY_ENTITY_ID], dst[keep]])
+        return src, rel, dst
 
-                    # Build the training subgraph
-                    if 'train' in data_file:
-                        if e1_id not in self.training_graph:
-                            self.training_graph[e1_id] = []
-                        self.training_graph[e1_id].append([r_id, e2_id])
-
-                        if e2_id not in self.training_graph:
-                            self.training_graph[e2_id] = []
-                        self.training_graph[e2_id].append([r_inv_id, e1_id])
+    def get_aux_edges(self, data_dir, eval_edges):
+        """
+        Extend the evaluation graph with the edges connecting unseen entities of the aux and test sets
+        to seen entities.
+        """
+        triples = np.concatenate([load_triple_ids(os.path.join(data_dir, file), self.entity2id, self.rel2id)
+                                  for file in ['aux.triples', 'test.triples']])
+        src, rel, dst = self.get_unseen_edges(triples)
+        return (np.concatenate([eval_edges[0], src]),
+                np.concatenate([eval_edges[1], rel]),
+                np.concatenate([eval_edges[2], dst]))
 
-        self.eval_graph[0] = [[2, 0]]
-        self.training_graph[0] = [[2, 0]]
-
-        self.load_aux_graph(data_dir)
+    def get_unseen_edges(self, triples):
+        """
+        :param triples: [num_triples, 3] array of (e1, e2, r) ids in the augmented entity index.
+        :return src, rel, dst: the edges from the unseen entities of the triples to the seen entities they are
+            linked to, without repeated edges.
+        """
+        triples = np.asarray(triples, dtype=np.int64).reshape(-1, 3)
+        e1, e2, r = triples[:, 0], triples[:, 1], triples[:, 2]
+        e1_seen = e1 < self.num_entities
+        e2_seen = e2 < self.num_entities
+        to_e2 = e1_seen & ~e2_seen
+        to_e1 = e2_seen & ~e1_seen
+        src = np.where(to_e2, e2, e1)
+        rel = np.where(to_e2, self.inv_rel_ids[r], r)
+        dst = np.where(to_e2, e1, e2)
+        keep = np.nonzero(to_e2 | to_e1)[0]
+        src, rel, dst = src[keep], rel[keep], dst[keep]
+        # Drop repeated edges, keeping the first occurrence
+        edge_keys = (src * self.num_relations + rel) * len(self.entity2id) + dst
+        _, first = np.unique(edge_keys, return_index=True)
+        first = np.sort(first)
+        return src[first], rel[first], dst[first]
 
-    def load_aux_graph(self, data_dir):
-        self.aux_graph.update(self.eval_graph)
-        data_files = ['aux.triples', 'test.triples']
-        for file in data_files:
-            with open(os.path.join(data_dir, file), encoding='utf-8') as f:
-                for i, line in enumerate(f.readlines()):
-                    e1, e2, r = line.strip().split()
-
-                    if e1 not in self.entity2id:
-                        e1_id = len(self.entity2id)
-                        self.entity2id[e1] = e1_id
-                        self.id2entity[e1_id] = e1
-
-                    if e2 not in self.entity2id:
-                        e2_id = len(self.entity2id)
-                        self.entity2id[e2] = e2_id
-                        self.id2entity[e2_id] = e2
-
-                    if e1 in self.seen_entity2id and e2 not in self.seen_entity2id:
-                        e1_id = self.entity2id[e1]
-                        r_inv_id = self.rel2id[r + '_inv']
-                        e2_id = self.entity2id[e2]
-                        if e2_id not in self.aux_graph:
-                            self.aux_graph[e2_id] = []
-                        if [r_inv_id, e1_id] not in self.aux_graph[e2_id]:
-                            self.aux_graph[e2_id].append([r_inv_id, e1_id])
-
-                    if e2 in self.seen_entity2id and e1 not in self.seen_entity2id:
-                        e1_id = self.entity2id[e1]
-                        r_id = self.rel2id[r]
-                        e2_id = self.entity2id[e2]
-                        if e1_id not in self.aux_graph:
-                            self.aux_graph[e1_id] = []
-                        if [r_id, e2_id] not in self.aux_graph[e1_id]:
-                            self.aux_graph[e1_id].append([r_id, e2_id])
+    def add_aux_triples(self, triples):
+        """
+        Index the unseen entities of aux triples and connect them to the seen entities they are linked to in
+        the aux graph. The aux graph is rebuilt, so its PageRank neighbor selections are recomputed on demand.
+        :param triples: List of (e1, e2, r) entity and relation names.
+        """
+        num_entities_added = add_entities(self.entity2id, self.id2entity,
+                                          [e for e1, e2, _ in triples for e in (e1, e2)])
+        num_nodes = len(self.entity2id)
+        triple_ids = [(self.entity2id[e1], self.entity2id[e2], self.rel2id[r]) for e1, e2, r in triples]
+        # the edges of the seen entities are the eval graph edges, the unseen entities only have aux edges
+        e1, r, e2 = self.aux_graph.get_edges()
+        is_seen = (e1 < self.num_entities)
+        aux_triples = np.concatenate([np.stack([e1[~is_seen], e2[~is_seen], r[~is_seen]], axis=1),
+                                      np.asarray(triple_ids, dtype=np.int64).reshape(-1, 3)])
+        src, rel, dst = self.get_unseen_edges(aux_triples)
+        neighbor_scores = np.concatenate([self.aux_graph.neighbor_scores, np.zeros(num_entities_added)])
+        self.aux_graph = CSRGraph(np.concatenate([e1[is_seen], src]), np.concatenate([r[is_seen], rel]),
+                                  np.concatenate([e2[is_seen], dst]), num_nodes, neighbor_scores=neighbor_scores)
+        self.is_seen_entity = torch.cat([self.is_seen_entity,
+                                         torch.zeros(num_entities_added, dtype=torch.bool, device=device)])
 
     def get_action_space(self, graph, e1, q):
-        action_space = [[r, e2] for (r, e2) in graph[e1] if r != q and r != q + 1]
+        lo, hi = graph.get_excluded_range(torch.LongTensor([e1]).to(device), torch.LongTensor([q]).to(device))
+        action_space = [[r, e2] for (r, e2) in graph[e1]]
+        start = graph.offsets[e1].item()
+        del action_space[lo.item() - start:hi.item() - start]
         return action_space
-
-
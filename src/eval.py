@@ -15,63 +15,180 @@ import torch
 
 from src.parse_args import args
 from src.data_utils import NO_OP_ENTITY_ID, DUMMY_ENTITY_ID
+from src.utils.ops import TopKScores
 
 
-def hits_and_ranks(examples, scores, all_answers, verbose=False):
+def filtered_ranks(examples, scores, all_answers):
     """
-    Compute ranking based metrics.
+    Compute the filtered rank of the target answer of each example. As in mask_false_negatives, the dummy
+    entities and the other known answers to the query are scored 0 rather than dropped, so they still rank
+    above a target with a negative score and tie with a target scored 0. The rank is one plus the number of
+    candidates scored higher than the target, or scored the same with a lower entity index: torch.topk does
+    not specify the order of tied scores, so ties are broken by entity index, as a stable sort of the
+    candidates would. The scores are not modified.
+
+    :param examples: List of (e1, e2, r) triples.
+    :param scores: [len(examples), num_entities] prediction scores or TopKScores.
+    :param all_answers: AnswerIndex of the known answers to each (e1, r) query.
+    :return: (Variable:len(examples)) filtered ranks. Targets missing from TopKScores are ranked
+        num_entities + 1, which RankingMetrics counts as a miss with a reciprocal rank of 0, as a target
+        outside the top k predictions.
     """
-    assert (len(examples) == scores.shape[0])
+    if isinstance(scores, TopKScores):
+        candidates, candidate_scores = scores.indices, scores.scores
+    else:
+        candidate_scores = scores
+        candidates = torch.arange(scores.size(1), device=scores.device).unsqueeze(0).expand_as(scores)
+    e1, e2, r = [torch.LongTensor(x).to(candidates.device) for x in zip(*examples)]
+    is_target = (candidates == e2.unsqueeze(1))
     # mask false negatives in the predictions
-    dummy_mask = [DUMMY_ENTITY_ID, NO_OP_ENTITY_ID]
-    for i, example in enumerate(examples):
-        e1, e2, r = example
-        e2_multi = dummy_mask + list(all_answers[e1][r]) 
-        # save the relevant prediction
-        target_score = float(scores[i, e2])
-        # mask all false negatives
-        scores[i, e2_multi] = 0
-        # write back the save prediction
-        scores[i, e2] = target_score
-    
-    # sort and rank
-    top_k_scores, top_k_targets = torch.topk(scores, min(scores.size(1), args.beam_size))
-    top_k_targets = top_k_targets.cpu().numpy()
-
-    hits_at_1 = 0
-    hits_at_3 = 0
-    hits_at_5 = 0
-    hits_at_10 = 0
-    mrr = 0
-    for i, example in enumerate(examples):
-        e1, e2, r = example
-        pos = np.where(top_k_targets[i] == e2)[0]
-        if len(pos) > 0:
-            pos = pos[0]
-            if pos < 10:
-                hits_at_10 += 1
-                if pos < 5:
-                    hits_at_5 += 1
-                    if pos < 3:
-                        hits_at_3 += 1
-                        if pos < 1:
-                            hits_at_1 += 1
-            mrr += 1.0 / (pos + 1)
-
-    hits_at_1 = float(hits_at_1) / len(examples)
-    hits_at_3 = float(hits_at_3) / len(examples)
-    hits_at_5 = float(hits_at_5) / len(examples)
-    hits_at_10 = float(hits_at_10) / len(examples)
-    mrr = float(mrr) / len(examples)
+    is_filtered = all_answers.contains(e1, r, candidates) | \
+        (candidates == DUMMY_ENTITY_ID) | (candidates == NO_OP_ENTITY_ID)
+    is_filtered &= ~is_target
+    candidate_scores = candidate_scores.masked_fill(is_filtered, 0)
+    target_scores = candidate_scores.masked_fill(~is_target, -float('inf')).max(dim=1, keepdim=True)[0]
+    is_ranked_higher = (candidate_scores > target_scores) | \
+        ((candidate_scores == target_scores) & (candidates < e2.unsqueeze(1)))
+    ranks = is_ranked_higher.sum(dim=1) + 1
+    if isinstance(scores, TopKScores):
+        ranks = ranks.masked_fill(~is_target.any(dim=1), scores.num_entities + 1)
+    return ranks
 
-    if verbose:
-        print('Hits@1 = {:.3f}'.format(hits_at_1))
-        print('Hits@3 = {:.3f}'.format(hits_at_3))
-        print('Hits@5 = {:.3f}'.format(hits_at_5))
-        print('Hits@10 = {:.3f}'.format(hits_at_10))
-        print('MRR = {:.3f}'.format(mrr))
 
-    return hits_at_1, hits_at_3, hits_at_5, hits_at_10, mrr
+class RankingMetrics():
+    """
+    Hits@k and MRR accumulated over mini-batches of filtered ranks. Only ranks within the beam
+    (rank <= max_rank) count as hits.
+    """
+    def __init__(self, max_rank=None):
+        self.max_rank = args.beam_size if max_rank is None else max_rank
+        self.num_examples = 0
+        self.num_hits = {1: 0, 3: 0, 5: 0, 10: 0}
+        self.reciprocal_rank_sum = 0
+
+    def update(self, ranks):
+        """
+        :param ranks: (Variable:batch) filtered ranks of a mini-batch of examples.
+        """
+        ranks = ranks.cpu()
+        is_hit = (ranks <= self.max_rank)
+        for k in self.num_hits:
+            self.num_hits[k] += int(((ranks <= k) & is_hit).sum())
+        self.reciprocal_rank_sum += float((1.0 / ranks.double()).masked_fill(~is_hit, 0).sum())
+        self.num_examples += len(ranks)
+
+    def get_metrics(self, verbose=False):
+        """
+        :return: Hits@1, Hits@3, Hits@5, Hits@10, MRR
+        """
+        num_examples = max(self.num_examples, 1)
+        hits_at_1 = float(self.num_hits[1]) / num_examples
+        hits_at_3 = float(self.num_hits[3]) / num_examples
+        hits_at_5 = float(self.num_hits[5]) / num_examples
+        hits_at_10 = float(self.num_hits[10]) / num_examples
+        mrr = self.reciprocal_rank_sum / num_examples
+
+        metrics = hits_at_1, hits_at_3, hits_at_5, hits_at_10, mrr
+        if verbose:
+            print_metrics(metrics)
+        return metrics
+
+
+def print_metrics(metrics):
+    """
+    Print the (Hits@1, Hits@3, Hits@5, Hits@10, MRR) tuple returned by RankingMetrics.
+    """
+    hits_at_1, hits_at_3, hits_at_5, hits_at_10, mrr = metrics
+    print('Hits@1 = {:.3f}'.format(hits_at_1))
+    print('Hits@3 = {:.3f}'.format(hits_at_3))
+    print('Hits@5 = {:.3f}'.format(hits_at_5))
+    print('Hits@10 = {:.3f}'.format(hits_at_10))
+    print('MRR = {:.3f}'.format(mrr))
+
+
+class SliceMetrics():
+    """
+    Ranking metrics of an evaluation set and of its slices, accumulated in one pass over the filtered ranks:
+        - overall;
+        - to-M and to-1 relations (if relation_by_types is given);
+        - seen and unseen queries (if seen_queries is given);
+        - each query relation.
+    """
+    def __init__(self, relation_by_types=None, seen_queries=None, max_rank=None):
+        self.relation_by_types = relation_by_types
+        self.seen_queries = seen_queries
+        self.max_rank = max_rank
+        self.slices = {'overall': RankingMetrics(max_rank)}
+        if relation_by_types is not None:
+            self.slices['to_M'] = RankingMetrics(max_rank)
+            self.slices['to_1'] = RankingMetrics(max_rank)
+        if seen_queries is not None:
+            self.slices['seen'] = RankingMetrics(max_rank)
+            self.slices['unseen'] = RankingMetrics(max_rank)
+        self.relation_slices = {}
+
+    def update(self, examples, ranks):
+        """
+        :param examples: List of (e1, e2, r) triples.
+        :param ranks: (Variable:len(examples)) filtered ranks of the examples.
+        """
+        ranks = ranks.cpu()
+        self.slices['overall'].update(ranks)
+        if self.relation_by_types is not None:
+            to_M_rels, _ = self.relation_by_types
+            is_to_M = torch.BoolTensor([r in to_M_rels for _, _, r in examples])
+            self.slices['to_M'].update(ranks[is_to_M])
+            self.slices['to_1'].update(ranks[~is_to_M])
+        if self.seen_queries is not None:
+            is_seen = torch.BoolTensor([(e1, r) in self.seen_queries for e1, _, r in examples])
+            self.slices['seen'].update(ranks[is_seen])
+            self.slices['unseen'].update(ranks[~is_seen])
+        q = torch.LongTensor([r for _, _, r in examples])
+        for r in q.unique().tolist():
+            if not r in self.relation_slices:
+                self.relation_slices[r] = RankingMetrics(self.max_rank)
+            self.relation_slices[r].update(ranks[q == r])
+
+    def get_metrics(self, name='overall'):
+        """
+        :param name: One of 'overall', 'to_M', 'to_1', 'seen' and 'unseen'.
+        :return: Hits@1, Hits@3, Hits@5, Hits@10, MRR
+        """
+        return self.slices[name].get_metrics()
+
+    def get_relation_metrics(self):
+        """
+        :return: Dictionary mapping each query relation to its Hits@1, Hits@3, Hits@5, Hits@10, MRR
+        """
+        return {r: metrics.get_metrics() for r, metrics in sorted(self.relation_slices.items())}
+
+    def print_metrics(self, id2rel=None):
+        """
+        Print the overall metrics and the MRR of each slice. The per-relation MRRs are printed if id2rel
+        is given.
+        """
+        print_metrics(self.get_metrics())
+        if self.relation_by_types is not None:
+            print('MRR on to-M relations: {:.3f}'.format(self.get_metrics('to_M')[4]))
+            print('MRR on to-1 relations: {:.3f}'.format(self.get_metrics('to_1')[4]))
+        if self.seen_queries is not None:
+            print('MRR on seen queries: {:.3f}'.format(self.get_metrics('seen')[4]))
+            print('MRR on unseen queries: {:.3f}'.format(self.get_metrics('unseen')[4]))
+        if id2rel is not None:
+            for r, metrics in self.get_relation_metrics().items():
+                print('MRR on {}: {:.3f} ({} examples)'.format(
+                    id2rel[r], metrics[4], self.relation_slices[r].num_examples))
+
+
+def hits_and_ranks(examples, scores, all_answers, verbose=False):
+    """
+    Compute ranking based metrics.
+    """
+    assert (len(examples) == scores.shape[0])
+    metrics = RankingMetrics()
+    if len(examples) > 0:
+        metrics.update(filtered_ranks(examples, scores, all_answers))
+    return metrics.get_metrics(verbose=verbose)
 
 def hits_at_k(examples, scores, all_answers, verbose=False):
     """
@@ -83,45 +200,7 @@ def hits_at_k(examples, scores, all_answers, verbose=False):
     :param verbose:
     """
     assert(len(examples) == scores.shape[0])
-    # mask false negatives in the predictions
-    dummy_mask = [DUMMY_ENTITY_ID, NO_OP_ENTITY_ID]
-    for i, example in enumerate(examples):
-        e1, e2, r = example
-        e2_multi = list(all_answers[e1][r]) + dummy_mask
-        # save the relevant prediction
-        target_score = scores[i, e2]
-        # mask all false negatives
-        scores[i][e2_multi] = 0
-        scores[i][dummy_mask] = 0
-        # write back the save prediction
-        scores[i][e2] = target_score
-        
-    # sort and rank
-    top_k_scores, top_k_targets = torch.topk(scores, min(scores.size(1), args.beam_size))
-    top_k_targets = top_k_targets.cpu().numpy()
-
-    hits_at_1 = 0
-    hits_at_3 = 0
-    hits_at_5 = 0
-    hits_at_10 = 0
-    for i, example in enumerate(examples):
-        e1, e2, r = example
-        pos = np.where(top_k_targets[i] == e2)[0]
-        if pos:
-            pos = pos[0]
-            if pos < 10:
-                hits_at_10 += 1
-                if pos < 5:
-                    hits_at_5 += 1
-                    if pos < 3:
-                        hits_at_3 += 1
-                        if pos < 1:
-                            hits_at_1 += 1
-
-    hits_at_1 = float(hits_at_1) / len(examples)
-    hits_at_3 = float(hits_at_3) / len(examples)
-    hits_at_5 = float(hits_at_5) / len(examples)
-    hits_at_10 = float(hits_at_10) / len(examples)
+    hits_at_1, hits_at_3, hits_at_5, hits_at_10, _ = hits_and_ranks(examples, scores, all_answers)
 
     if verbose:
         print('Hits@1 = {:.3f}'.format(hits_at_1))
@@ -132,39 +211,20 @@ def hits_at_k(examples, scores, all_answers, verbose=False):
     return hits_at_1, hits_at_3, hits_at_5, hits_at_10
 
 def hits_and_ranks_by_seen_queries(examples, scores, all_answers, seen_queries, verbose=False):
-    seen_exps, unseen_exps = [], []
-    seen_ids, unseen_ids = [], []
-    for i, example in enumerate(examples):
-        e1, e2, r = example
-        if (e1, r) in seen_queries:
-            seen_exps.append(example)
-            seen_ids.append(i)
-        else:
-            unseen_exps.append(example)
-            unseen_ids.append(i)
-
-    _, _, _, _, seen_mrr = hits_and_ranks(seen_exps, scores[seen_ids], all_answers, verbose=False)
-    _, _, _, _, unseen_mrr = hits_and_ranks(unseen_exps, scores[unseen_ids], all_answers, verbose=False)
+    metrics = SliceMetrics(seen_queries=seen_queries)
+    if len(examples) > 0:
+        metrics.update(examples, filtered_ranks(examples, scores, all_answers))
+    seen_mrr, unseen_mrr = metrics.get_metrics('seen')[4], metrics.get_metrics('unseen')[4]
     if verbose:
         print('MRR on seen queries: {:.3f}'.format(seen_mrr))
         print('MRR on unseen queries: {:.3f}'.format(unseen_mrr))
     return seen_mrr, unseen_mrr
 
 def hits_and_ranks_by_relation_type(examples, scores, all_answers, relation_by_types, verbose=False):
-    to_M_rels, to_1_rels = relation_by_types
-    to_M_exps, to_1_exps = [], []
-    to_M_ids, to_1_ids = [], []
-    for i, example in enumerate(examples):
-        e1, e2, r = example
-        if r in to_M_rels:
-            to_M_exps.append(example)
-            to_M_ids.append(i)
-        else:
-            to_1_exps.append(example)
-            to_1_ids.append(i)
-
-    _, _, _, _, to_m_mrr = hits_and_ranks(to_M_exps, scores[to_M_ids], all_answers, verbose=False)
-    _, _, _, _, to_1_mrr = hits_and_ranks(to_1_exps, scores[to_1_ids], all_answers, verbose=False)
+    metrics = SliceMetrics(relation_by_types=relation_by_types)
+    if len(examples) > 0:
+        metrics.update(examples, filtered_ranks(examples, scores, all_answers))
+    to_m_mrr, to_1_mrr = metrics.get_metrics('to_M')[4], metrics.get_metrics('to_1')[4]
     if verbose:
         print('MRR on to-M relations: {:.3f}'.format(to_m_mrr))
         print('MRR on to-1 relations: {:.3f}'.format(to_1_mrr))
@@ -175,6 +235,8 @@ def link_MAP(examples, scores, labels, all_answers, verbose=False):
     Per-query mean average precision.
     """
     assert (len(examples) == len(scores))
+    if isinstance(scores, TopKScores):
+        scores = scores.to_dense()
     queries = {}
     for i, example in enumerate(examples):
         e1, e2, r = example
@@ -195,9 +257,7 @@ def link_MAP(examples, scores, labels, all_answers, verbose=False):
                 num_pos += 1
                 acc_precision += float(num_pos) / (i + 1 - offset)
             else:
-                answer_set = {}
-                if e1 in all_answers and r in all_answers[e1]:
-                    answer_set = all_answers[e1][r]
+                answer_set = set(all_answers.get(e1, r).tolist())
                 if e2 in answer_set or e2 in dummy_mask:
                     print('False negative found: {}'.format(triple))
                     offset += 1 
@@ -214,29 +274,13 @@ def export_error_cases(examples, scores, all_answers, output_path):
     Export indices of examples to which the top-1 prediction is incorrect.
     """
     assert (len(examples) == scores.shape[0])
-    # mask false negatives in the predictions
-    dummy_mask = [DUMMY_ENTITY_ID, NO_OP_ENTITY_ID]
-    for i, example in enumerate(examples):
-        e1, e2, r = example
-        e2_multi = dummy_mask + list(all_answers[e1][r])
-        # save the relevant prediction
-        target_score = float(scores[i, e2])
-        # mask all false negatives
-        scores[i, e2_multi] = 0
-        # write back the save prediction
-        scores[i, e2] = target_score
-
-    # sort and rank
-    top_k_scores, top_k_targets = torch.topk(scores, min(scores.size(1), args.beam_size))
-    top_k_targets = top_k_targets.cpu().numpy()
+    ranks = filtered_ranks(examples, scores, all_answers).cpu().numpy()
 
     top_1_errors, top_10_errors = [], []
-    for i, example in enumerate(examples):
-        e1, e2, r = example
-        pos = np.where(top_k_targets[i] == e2)[0]
-        if len(pos) <= 0 or pos[0] > 0:
+    for i, rank in enumerate(ranks):
+        if rank > 1:
             top_1_errors.append(i)
-        if len(pos) <= 0 or pos[0] > 9:
+        if rank > 10:
             top_10_errors.append(i)
     with open(output_path, 'wb') as o_f:
         pickle.dump([top_1_errors, top_10_errors], o_f)        
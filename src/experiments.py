@@ -31,6 +31,8 @@ from src.emb.emb import EmbeddingBasedMethod
 from src.rl.graph_search.pn import GraphSearchPolicy
 from src.rl.graph_search.pg import PolicyGradient
 from src.rl.graph_search.rs_pg import RewardShapingPolicyGradient
+from src.server import run_server
+from src.batch_inference import run_batch_inference
 from src.utils.ops import flatten
 
 torch.cuda.set_device(args.gpu)
@@ -249,8 +251,7 @@ def train(lf):
         train_path, entity_index_path, relation_index_path, group_examples_by_query=args.group_examples_by_query,
         add_reverse_relations=args.add_reversed_training_edges)
     if 'NELL' in args.data_dir:
-        adj_list_path = os.path.join(args.data_dir, 'adj_list.pkl')
-        seen_entities = data_utils.load_seen_entities(adj_list_path, entity_index_path)
+        seen_entities = data_utils.load_seen_entities(args.data_dir, entity_index_path)
     else:
         seen_entities = set()
     dev_data = data_utils.load_triples(dev_path, entity_index_path, relation_index_path, seen_entities=seen_entities)
@@ -278,8 +279,7 @@ def inference(lf):
     entity_index_path = os.path.join(args.data_dir, 'entity2id.txt')
     relation_index_path = os.path.join(args.data_dir, 'relation2id.txt')
     if 'NELL' in args.data_dir:
-        adj_list_path = os.path.join(args.data_dir, 'adj_list.pkl')
-        seen_entities = data_utils.load_seen_entities(adj_list_path, entity_index_path)
+        seen_entities = data_utils.load_seen_entities(args.data_dir, entity_index_path)
     else:
         seen_entities = set()
 
@@ -312,29 +312,18 @@ def inference(lf):
         map_ = np.mean(mps)
         print('Overall MAP = {}'.format(map_))
         eval_metrics['test']['avg_map'] = map
-    elif args.eval_by_relation_type:
+    elif args.eval_by_relation_type or args.eval_by_seen_queries:
         dev_path = os.path.join(args.data_dir, 'dev.triples')
         dev_data = data_utils.load_triples(dev_path, entity_index_path, relation_index_path, seen_entities=seen_entities)
-        pred_scores = lf.forward(dev_data, verbose=False)
         to_m_rels, to_1_rels, _ = data_utils.get_relations_by_type(args.data_dir, relation_index_path)
-        relation_by_types = (to_m_rels, to_1_rels)
-        print('Dev set evaluation by relation type (partial graph)')
-        src.eval.hits_and_ranks_by_relation_type(
-            dev_data, pred_scores, lf.kg.dev_objects, relation_by_types, verbose=True)
-        print('Dev set evaluation by relation type (full graph)')
-        src.eval.hits_and_ranks_by_relation_type(
-            dev_data, pred_scores, lf.kg.all_objects, relation_by_types, verbose=True)
-    elif args.eval_by_seen_queries:
-        dev_path = os.path.join(args.data_dir, 'dev.triples')
-        dev_data = data_utils.load_triples(dev_path, entity_index_path, relation_index_path, seen_entities=seen_entities)
-        pred_scores = lf.forward(dev_data, verbose=False)
-        seen_queries = data_utils.get_seen_queries(args.data_dir, entity_index_path, relation_index_path)
-        print('Dev set evaluation by seen queries (partial graph)')
-        src.eval.hits_and_ranks_by_seen_queries(
-            dev_data, pred_scores, lf.kg.dev_objects, seen_queries, verbose=True)
-        print('Dev set evaluation by seen queries (full graph)')
-        src.eval.hits_and_ranks_by_seen_queries(
-            dev_data, pred_scores, lf.kg.all_objects, seen_queries, verbose=True)
+        seen_queries, _ = data_utils.get_seen_queries(args.data_dir, entity_index_path, relation_index_path)
+        dev_metrics, all_metrics = lf.evaluate_slices(
+            dev_data, [lf.kg.dev_objects, lf.kg.all_objects], relation_by_types=(to_m_rels, to_1_rels),
+            seen_queries=seen_queries)
+        print('Dev set evaluation by slice (partial graph)')
+        dev_metrics.print_metrics(id2rel=lf.kg.id2relation)
+        print('Dev set evaluation by slice (full graph)')
+        all_metrics.print_metrics(id2rel=lf.kg.id2relation)
     else:
         dev_path = os.path.join(args.data_dir, 'dev.triples')
         test_path = os.path.join(args.data_dir, 'test.triples')
@@ -344,33 +333,50 @@ def inference(lf):
             test_path, entity_index_path, relation_index_path, seen_entities=seen_entities, verbose=False)
 
         print('Dev set performance:')
-        pred_scores = lf.forward(dev_data, verbose=args.save_beam_search_paths)
-        dev_metrics = src.eval.hits_and_ranks(dev_data, pred_scores, lf.kg.dev_objects, verbose=True)
+        dev_metrics, all_metrics = lf.evaluate(
+            dev_data, [lf.kg.dev_objects, lf.kg.all_objects], verbose=args.save_beam_search_paths)
+        src.eval.print_metrics(dev_metrics)
         eval_metrics['dev'] = {}
         eval_metrics['dev']['hits_at_1'] = dev_metrics[0]
         eval_metrics['dev']['hits_at_3'] = dev_metrics[1]
         eval_metrics['dev']['hits_at_5'] = dev_metrics[2]
         eval_metrics['dev']['hits_at_10'] = dev_metrics[3]
         eval_metrics['dev']['mrr'] = dev_metrics[4]
-        src.eval.hits_and_ranks(dev_data, pred_scores, lf.kg.all_objects, verbose=True)
+        src.eval.print_metrics(all_metrics)
 
         print('Test set performance:')
-        pred_scores = lf.forward(test_data, verbose=args.save_beam_search_paths)
-        test_metrics = src.eval.hits_and_ranks(test_data, pred_scores, lf.kg.all_objects, verbose=True)
+        # Evaluation on test data by relation types
+        to_m_rels, to_1_rels, _ = data_utils.get_relations_by_type(args.data_dir, relation_index_path)
+        test_metrics, = lf.evaluate_slices(
+            test_data, [lf.kg.all_objects], relation_by_types=(to_m_rels, to_1_rels),
+            verbose=args.save_beam_search_paths)
+        test_metrics.print_metrics()
+        test_metrics = test_metrics.get_metrics()
         eval_metrics['test']['hits_at_1'] = test_metrics[0]
         eval_metrics['test']['hits_at_3'] = test_metrics[1]
         eval_metrics['test']['hits_at_5'] = test_metrics[2]
         eval_metrics['test']['hits_at_10'] = test_metrics[3]
         eval_metrics['test']['mrr'] = test_metrics[4]
-
-        # Evaluation on test data by relation types
-        to_m_rels, to_1_rels, _ = data_utils.get_relations_by_type(args.data_dir, relation_index_path)
-        relation_by_types = (to_m_rels, to_1_rels)
-        print('Test set evaluation by relation type (full graph)')
-        src.eval.hits_and_ranks_by_relation_type(
-            test_data, pred_scores, lf.kg.all_objects, relation_by_types, verbose=True)
     return eval_metrics
 
+def serve(lf):
+    if not args.model.startswith('point'):
+        raise NotImplementedError
+    lf.batch_size = args.dev_batch_size
+    lf.eval()
+    lf.load_checkpoint(get_checkpoint_path(args))
+    run_server(lf, args)
+
+def batch_inference(lf):
+    if not args.model.startswith('point'):
+        raise NotImplementedError
+    if args.predict_output is None:
+        raise ValueError('--predict_input requires --predict_output')
+    lf.batch_size = args.dev_batch_size
+    lf.eval()
+    lf.load_checkpoint(get_checkpoint_path(args))
+    run_batch_inference(lf, args)
+
 def run_ablation_studies(args):
     """
     Run the ablation study experiments reported in the paper.
@@ -392,8 +398,7 @@ def run_ablation_studies(args):
     entity_index_path = os.path.join(args.data_dir, 'entity2id.txt')
     relation_index_path = os.path.join(args.data_dir, 'relation2id.txt')
     if 'NELL' in args.data_dir:
-        adj_list_path = os.path.join(args.data_dir, 'adj_list.pkl')
-        seen_entities = data_utils.load_seen_entities(adj_list_path, entity_index_path)
+        seen_entities = data_utils.load_seen_entities(args.data_dir, entity_index_path)
     else:
         seen_entities = set()
     dataset = os.path.basename(args.data_dir)
@@ -424,30 +429,30 @@ def run_ablation_studies(args):
             args = data_utils.load_configs(args, config_path)
         
         lf = set_up_lf_for_inference(args)
-        pred_scores = lf.forward(dev_data, verbose=False)
-        _, _, _, _, mrr = src.eval.hits_and_ranks(dev_data, pred_scores, lf.kg.dev_objects, verbose=True)
+        dev_metrics, all_metrics = lf.evaluate_slices(
+            dev_data, [lf.kg.dev_objects, lf.kg.all_objects], relation_by_types=relation_by_types,
+            seen_queries=seen_queries)
+        dev_metrics.print_metrics()
+        mrr = dev_metrics.get_metrics()[4]
         if to_1_ratio == 0:
             to_m_mrr = mrr
             to_1_mrr = -1
         else:
-            to_m_mrr, to_1_mrr = src.eval.hits_and_ranks_by_relation_type(
-                dev_data, pred_scores, lf.kg.dev_objects, relation_by_types, verbose=True)
-        seen_mrr, unseen_mrr = src.eval.hits_and_ranks_by_seen_queries(
-            dev_data, pred_scores, lf.kg.dev_objects, seen_queries, verbose=True)
+            to_m_mrr, to_1_mrr = dev_metrics.get_metrics('to_M')[4], dev_metrics.get_metrics('to_1')[4]
+        seen_mrr, unseen_mrr = dev_metrics.get_metrics('seen')[4], dev_metrics.get_metrics('unseen')[4]
         mrrs[system] = {'': mrr * 100}
         to_m_mrrs[system] = {'': to_m_mrr * 100}
         to_1_mrrs[system] = {'': to_1_mrr  * 100}
         seen_mrrs[system] = {'': seen_mrr * 100}
         unseen_mrrs[system] = {'': unseen_mrr * 100}
-        _, _, _, _, mrr_full_kg = src.eval.hits_and_ranks(dev_data, pred_scores, lf.kg.all_objects, verbose=True)
+        all_metrics.print_metrics()
+        mrr_full_kg = all_metrics.get_metrics()[4]
         if to_1_ratio == 0:
             to_m_mrr_full_kg = mrr_full_kg
             to_1_mrr_full_kg = -1
         else:
-            to_m_mrr_full_kg, to_1_mrr_full_kg = src.eval.hits_and_ranks_by_relation_type(
-                dev_data, pred_scores, lf.kg.all_objects, relation_by_types, verbose=True)
-        seen_mrr_full_kg, unseen_mrr_full_kg = src.eval.hits_and_ranks_by_seen_queries(
-            dev_data, pred_scores, lf.kg.all_objects, seen_queries, verbose=True)
+            to_m_mrr_full_kg, to_1_mrr_full_kg = all_metrics.get_metrics('to_M')[4], all_metrics.get_metrics('to_1')[4]
+        seen_mrr_full_kg, unseen_mrr_full_kg = all_metrics.get_metrics('seen')[4], all_metrics.get_metrics('unseen')[4]
         mrrs[system]['full_kg'] = mrr_full_kg * 100
         to_m_mrrs[system]['full_kg'] = to_m_mrr_full_kg * 100
         to_1_mrrs[system]['full_kg'] = to_1_mrr_full_kg * 100
@@ -770,12 +775,20 @@ def run_experiment(args):
             elif args.run_ablation_studies:
                 run_ablation_studies(args)
             else:
+                if args.serve or args.predict_input:
+                    # queries about unseen entities are answered on the aux graph
+                    args.inference = True
+                    args.save_beam_search_paths = True
                 initialize_model_directory(args)
                 lf = construct_model(args)
                 lf.cuda()
 
                 if args.train:
                     train(lf)
+                elif args.serve:
+                    serve(lf)
+                elif args.predict_input:
+                    batch_inference(lf)
                 elif args.inference:
                     inference(lf)
                 elif args.eval_by_relation_type:
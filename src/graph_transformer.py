@@ -14,43 +14,111 @@ import torch.nn.functional as F
 import torch.cuda as cuda
 from torch.distributions.bernoulli import Bernoulli
 import math
-import random
 import time
+
+import src.utils.ops as ops
 device = torch.device("cuda" if cuda.is_available() else "cpu")
 print(device)
 HUGE_INT = 1e31
 
+def parameters_version(params):
+    """
+    Identify the current values of a list of parameters by their storages and version counters, which are
+    bumped by every in-place update (optimizer steps, load_state_dict).
+    """
+    return tuple((p.data_ptr(), p._version) for p in params)
+
+
 class MultiheadAttention(nn.Module):
+    """
+    Multi-head attention with the Query, Key and Value projections of all heads packed into one Linear
+    layer each. Head i uses rows [i*head_dim, (i+1)*head_dim) of the packed weights.
+    """
     def __init__(self, embed_dim, head_dim, num_heads, dropout):
         super(MultiheadAttention, self).__init__()
-        self.Query = nn.ModuleList()
-        self.Key = nn.ModuleList()
-        self.Value = nn.ModuleList()
         self.head_dim = head_dim
+        self.num_heads = num_heads
         assert head_dim * num_heads == embed_dim
 
-        for _ in range(num_heads):
-            self.Query.append(nn.Linear(embed_dim, head_dim))
-            self.Key.append(nn.Linear(embed_dim, head_dim))
-            self.Value.append(nn.Sequential(
-                                            nn.Linear(3*embed_dim, head_dim),
-                                            nn.LeakyReLU()
-                                            ))
+        self.query_proj = nn.Linear(embed_dim, num_heads * head_dim)
+        self.key_proj = nn.Linear(embed_dim, num_heads * head_dim)
+        self.value_proj = nn.Linear(3*embed_dim, num_heads * head_dim)
+
+    def split_heads(self, x):
+        """
+        [batch_size, seq_len, num_heads*head_dim] => [batch_size, num_heads, seq_len, head_dim]
+        """
+        return x.view(x.size(0), x.size(1), self.num_heads, self.head_dim).transpose(1, 2)
 
     def forward(self, query, key, value, masks):
-        attn_output = []
-        for Q, K, V in zip(self.Query, self.Key, self.Value):
-            attn_weights = F.softmax((torch.bmm(Q(query), torch.transpose(K(key), 2, 1)) / math.sqrt(self.head_dim)) - HUGE_INT * (1 - masks.unsqueeze(1)), dim=2)
-            attn_output.append(torch.bmm(attn_weights, V(value)))
+        return self.attend(self.query_proj(query), self.key_proj(key), value, masks)
 
-        attn_output = torch.cat(attn_output, dim=2)
+    def attend(self, query_proj, key_proj, value, masks):
+        """
+        Attention over already projected queries and keys.
+        :param query_proj: [batch_size, query_len, num_heads*head_dim] output of query_proj.
+        :param key_proj: [batch_size, key_len, num_heads*head_dim] output of key_proj.
+        :param value: [batch_size, key_len, 3*embed_dim] values.
+        :param masks: [batch_size, key_len] key masks.
+        """
+        Q = self.split_heads(query_proj)
+        K = self.split_heads(key_proj)
+        V = self.split_heads(F.leaky_relu(self.value_proj(value)))
+        # [batch_size, num_heads, query_len, key_len]
+        attn_scores = torch.matmul(Q, K.transpose(3, 2)) / math.sqrt(self.head_dim)
+        attn_weights = F.softmax(attn_scores - HUGE_INT * (1 - masks.unsqueeze(1).unsqueeze(1)), dim=3)
+        # [batch_size, num_heads, query_len, head_dim] => [batch_size, query_len, num_heads*head_dim]
+        attn_output = torch.matmul(attn_weights, V).transpose(1, 2)
+        attn_output = attn_output.reshape(attn_output.size(0), attn_output.size(1), -1)
 
         return attn_output
 
+    def attend_ragged(self, query_proj, key_proj, value, segment_ids, num_segments):
+        """
+        Attention of single queries over packed variable-length key sequences.
+        :param query_proj: [num_segments, num_heads*head_dim] output of query_proj.
+        :param key_proj: [num_keys, num_heads*head_dim] output of key_proj of the packed keys.
+        :param value: [num_keys, 3*embed_dim] packed values.
+        :param segment_ids: [num_keys] query (segment) index of each key.
+        :param num_segments: Number of queries.
+        :return: [num_segments, num_heads*head_dim] attention outputs (0 for queries without keys).
+        """
+        num_keys = len(segment_ids)
+        Q = query_proj[segment_ids].view(num_keys, self.num_heads, self.head_dim)
+        K = key_proj.view(num_keys, self.num_heads, self.head_dim)
+        V = F.leaky_relu(self.value_proj(value)).view(num_keys, self.num_heads, self.head_dim)
+        # [num_keys, num_heads]
+        attn_weights = ops.segment_softmax((Q * K).sum(dim=2) / math.sqrt(self.head_dim), segment_ids, num_segments)
+        attn_output = V.new_zeros(num_segments, self.num_heads, self.head_dim)
+        attn_output = attn_output.index_add(0, segment_ids, attn_weights.unsqueeze(2) * V)
+        return attn_output.view(num_segments, -1)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        # Convert checkpoints saved with one Linear layer per head
+        # (Query.<i>.*, Key.<i>.*, Value.<i>.0.*) to the packed projections
+        for legacy_name, legacy_suffix, name in [('Query', '', 'query_proj'),
+                                                 ('Key', '', 'key_proj'),
+                                                 ('Value', '.0', 'value_proj')]:
+            for param_name in ['weight', 'bias']:
+                legacy_keys = ['{}{}.{}{}.{}'.format(prefix, legacy_name, i, legacy_suffix, param_name)
+                               for i in range(self.num_heads)]
+                if all(key in state_dict for key in legacy_keys):
+                    state_dict['{}{}.{}'.format(prefix, name, param_name)] = \
+                        torch.cat([state_dict.pop(key) for key in legacy_keys], dim=0)
+        super(MultiheadAttention, self)._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+
 
 class GraphTransformer(nn.Module):
-    def __init__(self, kg, num_layers, num_heads, dropout, embed_dim, hidden_dim, neighbor_dropout_rate):
+    def __init__(self, kg, num_layers, num_heads, dropout, embed_dim, hidden_dim, neighbor_dropout_rate,
+                 eval_neighbor_selection='random', padded_neighbor_attention=False, record_attention_stats=False):
         super(GraphTransformer, self).__init__()
+        self.eval_neighbor_selection = eval_neighbor_selection
+        self.padded_neighbor_attention = padded_neighbor_attention
+        # Neighbor rows attended to and peak memory of the attention (see get_attention_stats)
+        self.record_attention_stats = record_attention_stats
+        self.reset_attention_stats()
         self.emb_e = nn.Embedding(kg.num_entities, embed_dim, padding_idx=0)
         self.emb_r = nn.Embedding(kg.num_relations, embed_dim, padding_idx=0)
         self.dropout = nn.Dropout(dropout)
@@ -72,64 +140,160 @@ class GraphTransformer(nn.Module):
             self.layernorm_1.append(nn.LayerNorm(embed_dim, eps=1e-05))
             self.layernorm_2.append(nn.LayerNorm(embed_dim, eps=1e-05))
 
+        # Query and Key projections of the relation table of each layer in eval mode (see
+        # get_relation_projections)
+        self.relation_projections = None
+        self.relation_projections_version = None
+
     def initialize_modules(self):
         nn.init.xavier_uniform_(self.emb_e.weight)
         nn.init.xavier_normal_(self.emb_r.weight)
 
-    def get_neighbors(self, graph, e1, q):
-        action_space = [[r, e2] for (r, e2) in graph[e1] if r != q and r != q + 1]
-        return action_space
+    def get_relation_projections(self):
+        """
+        In eval mode the attention queries and keys are relation embeddings without dropout, so the Query
+        and Key projections of every layer only have num_relations distinct outputs. Project the relation
+        table once and reuse it until any of the parameters involved is modified (tracked by the tensor
+        version counters). The projections are not differentiable.
+
+        :return: List of (query projection, key projection) [num_relations, embed_dim] tables, one per layer.
+        """
+        params = [self.emb_r.weight]
+        for attention in self.attentions:
+            params += [attention.query_proj.weight, attention.query_proj.bias,
+                       attention.key_proj.weight, attention.key_proj.bias]
+        version = parameters_version(params)
+        if self.relation_projections is None or self.relation_projections_version != version:
+            with torch.no_grad():
+                self.relation_projections = [(attention.query_proj(self.emb_r.weight),
+                                              attention.key_proj(self.emb_r.weight))
+                                             for attention in self.attentions]
+            self.relation_projections_version = version
+        return self.relation_projections
 
     def vectorize_neighbors(self, batch_e1, batch_q, graph, num_max_neighbors, mode):
-        neighbors = [self.get_neighbors(graph, e1, q) for e1, q in zip(batch_e1, batch_q)]
-
-        masks = []
-        for i, n_i in enumerate(neighbors):
-            if len(n_i) > num_max_neighbors:
-                n_i = random.sample(n_i, num_max_neighbors)
-                mask = [1.0 for j in range(len(n_i))]
-                masks.append(mask)
-                neighbors[i] = n_i
-            else:
-                mask = [1.0 for j in range(len(n_i))] + [0.0 for j in range(num_max_neighbors - len(n_i))]
-                masks.append(mask)
-                neighbors[i] += [[0, 0] for j in range(num_max_neighbors - len(n_i))] # Padding
+        if mode != 'train' and self.eval_neighbor_selection == 'pagerank':
+            # Deterministic selection of the neighbors with the highest PageRank scores
+            (neighbor_r, neighbor_e), masks = graph.get_top_neighbors(batch_e1, batch_q, num_max_neighbors)
+        else:
+            (neighbor_r, neighbor_e), masks = graph.get_neighbors(batch_e1, batch_q)
 
-        neighbors = torch.LongTensor(neighbors).to(device)
-        r = self.dropout(self.emb_r(neighbors[:, :, 0]))
-        e = self.dropout(self.emb_e(neighbors[:, :, 1]))
+        if neighbor_r.size(1) > num_max_neighbors:
+            # Randomly sample num_max_neighbors of the remaining neighbors of every entity; the
+            # masked-out positions get the largest keys so that they are only picked as padding
+            sample_keys = torch.rand(masks.size(), device=masks.device).masked_fill(~masks, 2)
+            _, sample_ids = torch.topk(sample_keys, num_max_neighbors, dim=1, largest=False)
+            neighbor_r = torch.gather(neighbor_r, 1, sample_ids)
+            neighbor_e = torch.gather(neighbor_e, 1, sample_ids)
+            masks = torch.gather(masks, 1, sample_ids)
+        elif neighbor_r.size(1) < num_max_neighbors:
+            # Padding
+            padding = neighbor_r.new_zeros(neighbor_r.size(0), num_max_neighbors - neighbor_r.size(1))
+            neighbor_r = torch.cat([neighbor_r, padding], dim=1)
+            neighbor_e = torch.cat([neighbor_e, padding], dim=1)
+            masks = torch.cat([masks, padding.bool()], dim=1)
+        neighbor_r = neighbor_r * masks.long()
+        neighbor_e = neighbor_e * masks.long()
 
-        masks = torch.FloatTensor(masks).to(device)
+        masks = masks.float()
         if mode == 'train':
             neighbor_dropout = self.bernoulli_dist.sample([len(batch_e1), num_max_neighbors]).squeeze(2).to(device)
             masks = masks * neighbor_dropout
         masks.requires_grad = True
 
-        return (r, e), masks
+        return (neighbor_r, neighbor_e), masks
 
-    def forward(self, batch_e1, batch_q, graph, seen_entities, num_max_neighbors, mode):
+    def forward(self, batch_e1, batch_q, graph, is_seen_entity, num_max_neighbors, mode):
+        """
+        :param batch_e1: (Variable:batch) entity indices.
+        :param batch_q: (Variable:batch) query relation indices.
+        :param graph: Neighbor graph (CSRGraph).
+        :param is_seen_entity: [num_aug_entities] mask of the entities with an embedding. In test mode the
+            other (unseen) entities start from the dummy entity embedding.
+        :param num_max_neighbors: Maximum number of neighbors attended to.
+        :param mode: 'train', 'eval' or 'test'.
+        """
         if mode == 'test':
-            batch_e1_aug = batch_e1.clone()  # Changes made here
-            for i in range(batch_e1_aug.size()[0]):
-                if batch_e1_aug[i].item() not in seen_entities:
-                    batch_e1_aug[i] = 0
-            emb_e1 = self.emb_e(batch_e1_aug)
+            emb_e1 = self.emb_e(batch_e1.masked_fill(~is_seen_entity[batch_e1], 0))
         else:
             emb_e1 = self.emb_e(batch_e1)
         emb_q = self.emb_r(batch_q)
 
+        (neighbor_r, neighbor_e), masks = self.vectorize_neighbors(batch_e1, batch_q, graph, num_max_neighbors, mode)
+        if self.record_attention_stats and cuda.is_available():
+            memory_before = cuda.memory_allocated()
+            cuda.reset_peak_memory_stats()
+        if self.padded_neighbor_attention:
+            h = self.encode_padded(emb_e1, emb_q, batch_q, neighbor_r, neighbor_e, masks)
+        else:
+            h = self.encode_ragged(emb_e1, emb_q, batch_q, neighbor_r, neighbor_e, masks)
+        if self.record_attention_stats:
+            self.attention_stats['num_batches'] += 1
+            self.attention_stats['num_padded_rows'] += neighbor_r.numel()
+            self.attention_stats['num_packed_rows'] += int((masks.detach() > 0).sum())
+            if cuda.is_available():
+                peak_memory = cuda.max_memory_allocated() - memory_before
+                self.attention_stats['peak_memory'] = max(self.attention_stats['peak_memory'], peak_memory)
+
+        return h, emb_q
+
+    def reset_attention_stats(self):
+        self.attention_stats = {'num_batches': 0, 'num_padded_rows': 0, 'num_packed_rows': 0, 'peak_memory': 0}
+
+    def get_attention_stats(self, reset=True):
+        """
+        Recorded if record_attention_stats is set.
+        :return: Number of encoded batches, number of neighbor rows of the padded attention, number of valid
+            (packed) neighbor rows and peak GPU memory in bytes allocated by the attention of a batch, since the
+            last reset. The attention FLOPs are proportional to the number of neighbor rows attended to: the
+            padded rows with --padded_neighbor_attention, the packed rows otherwise.
+        """
+        stats = dict(self.attention_stats)
+        if reset:
+            self.reset_attention_stats()
+        return stats
+
+    def print_attention_stats(self, reset=True):
+        stats = self.get_attention_stats(reset=reset)
+        if stats['num_batches'] == 0:
+            return
+        print('Graph transformer ({} attention): {} batches, {} padded neighbor rows, {} packed neighbor rows '
+              '({:.3f}), peak attention memory per batch = {:.1f} MB'.format(
+                  'padded' if self.padded_neighbor_attention else 'packed', stats['num_batches'],
+                  stats['num_padded_rows'], stats['num_packed_rows'],
+                  float(stats['num_packed_rows']) / max(stats['num_padded_rows'], 1), stats['peak_memory'] / 2**20))
+
+    def encode_padded(self, emb_e1, emb_q, batch_q, neighbor_r, neighbor_e, masks):
+        """
+        Attend over the neighbors padded to the same length.
+        :param emb_e1: [batch_size, embed_dim] entity embeddings.
+        :param emb_q: [batch_size, embed_dim] query relation embeddings.
+        :param batch_q: (Variable:batch) query relation indices.
+        :param neighbor_r, neighbor_e: [batch_size, num_max_neighbors] neighbor relation and entity indices.
+        :param masks: [batch_size, num_max_neighbors] neighbor masks.
+        :return: [batch_size, embed_dim] entity representations.
+        """
+        num_max_neighbors = neighbor_r.size(1)
+        r = self.dropout(self.emb_r(neighbor_r))
+        e = self.dropout(self.emb_e(neighbor_e))
+
         h = emb_e1
         h_ = h.unsqueeze(1).expand(-1, num_max_neighbors, -1)
 
-        (r, e), masks = self.vectorize_neighbors(batch_e1.cpu().numpy().tolist(), batch_q.cpu().numpy().tolist(), graph, num_max_neighbors, mode)
-
         key = r
         value = torch.cat([h_, r, e], dim=2)
         query = emb_q.unsqueeze(1)
+        if not self.training:
+            relation_projections = self.get_relation_projections()
 
-        for attention, ln_1, feed_forward, ln_2 in zip(self.attentions, self.layernorm_1, self.feed_forwards, self.layernorm_2):
+        for i, (attention, ln_1, feed_forward, ln_2) in enumerate(zip(self.attentions, self.layernorm_1, self.feed_forwards, self.layernorm_2)):
 
-            x = attention(query, key, value, masks)  # Multihead attention
+            # Multihead attention
+            if self.training:
+                x = attention(query, key, value, masks)
+            else:
+                query_table, key_table = relation_projections[i]
+                x = attention.attend(query_table[batch_q].unsqueeze(1), key_table[neighbor_r], value, masks)
             x = x.squeeze(1)
             x = self.dropout(x)
             h = h + x   # Residual connection
@@ -142,6 +306,171 @@ class GraphTransformer(nn.Module):
             h_ = h.unsqueeze(1).expand(-1, num_max_neighbors, -1)
             value = torch.cat([h_, r, e], dim=2)
 
-        return h, emb_q
+        return h
+
+    def encode_ragged(self, emb_e1, emb_q, batch_q, neighbor_r, neighbor_e, masks):
+        """
+        Same as encode_padded, but only the valid neighbors are packed and attended to (with a segment
+        softmax per entity), so no work is spent on the padding.
+        """
+        is_neighbor = masks.detach() > 0
+        has_neighbors = is_neighbor.any(dim=1)
+        # [num_neighbors] packed neighbors, grouped by entity
+        segment_ids, columns = is_neighbor.nonzero(as_tuple=True)
+        packed_r = neighbor_r[segment_ids, columns]
+        r = self.dropout(self.emb_r(packed_r))
+        e = self.dropout(self.emb_e(neighbor_e[segment_ids, columns]))
+        num_segments = len(emb_e1)
+
+        h = emb_e1
+        if not self.training:
+            relation_projections = self.get_relation_projections()
+
+        for i, (attention, ln_1, feed_forward, ln_2) in enumerate(zip(self.attentions, self.layernorm_1, self.feed_forwards, self.layernorm_2)):
 
+            # Multihead attention
+            value = torch.cat([h[segment_ids], r, e], dim=1)
+            if self.training:
+                x = attention.attend_ragged(attention.query_proj(emb_q), attention.key_proj(r), value,
+                                            segment_ids, num_segments)
+            else:
+                query_table, key_table = relation_projections[i]
+                x = attention.attend_ragged(query_table[batch_q], key_table[packed_r], value,
+                                            segment_ids, num_segments)
+            x = self.dropout(x)
+            h = h + x   # Residual connection
+            h = ln_1(h)  # layer norm
+            x = feed_forward(h)  # feed forward
+            x = self.dropout(x)
+            h = h + x  # Residual connection
+            h = ln_2(h)  # layer norm
+
+        if not bool(has_neighbors.all()):
+            # The padded attention of an entity without neighbors is uniform over its padding positions
+            no_neighbors = ~has_neighbors
+            h_no_neighbors = self.encode_padded(emb_e1[no_neighbors], emb_q[no_neighbors], batch_q[no_neighbors],
+                                                neighbor_r[no_neighbors], neighbor_e[no_neighbors], masks[no_neighbors])
+            h = h.index_put((no_neighbors,), h_no_neighbors)
+
+        return h
+
+
+class EntityRepresentationCache():
+    """
+    Bounded cache of eval-mode entity representations keyed by (entity, query relation) and namespaced by
+    graph and mode. Each namespace holds at most `capacity` representations in device tensors and evicts
+    with the CLOCK policy. The whole cache is dropped when the graph transformer parameters change. The
+    representations must be deterministic, i.e. computed with the PageRank neighbor selection.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.stores = {}
+        self.version = None
+        self.num_lookups = 0
+        self.num_hits = 0
+
+    def lookup(self, keys, namespace, version, encode):
+        """
+        :param keys: (Variable:batch) unique entity * num_relations + query relation keys.
+        :param namespace: Graph and mode the representations are computed with.
+        :param version: parameters_version of the graph transformer.
+        :param encode: Function computing the [len(keys), dim] representations of a subset of the keys.
+        :return: [batch_size, dim] representations of the keys.
+        """
+        if len(keys) == 0:
+            # the store holds no values before its first insert
+            return encode(keys).detach()
+        if version != self.version:
+            self.stores = {}
+            self.version = version
+        if not namespace in self.stores:
+            self.stores[namespace] = ClockStore(self.capacity, keys.device)
+        store = self.stores[namespace]
+
+        slots, found = store.find(keys)
+        self.num_lookups += len(keys)
+        self.num_hits += int(found.sum())
+        if bool(found.all()):
+            return store.get(slots)
+        miss = ~found
+        miss_values = encode(keys[miss]).detach()
+        values = miss_values.new_empty(len(keys), miss_values.size(1))
+        values[miss] = miss_values
+        if bool(found.any()):
+            values[found] = store.get(slots[found])
+        store.insert(keys[miss], miss_values)
+        return values
+
+    def clear(self):
+        self.stores = {}
+
+    def get_hit_rate(self):
+        return float(self.num_hits) / max(self.num_lookups, 1)
+
+    def get_memory_usage(self):
+        """
+        :return: Number of bytes held by the cached keys and representations.
+        """
+        return sum(store.get_memory_usage() for store in self.stores.values())
+
+    def print_stats(self):
+        print('Entity representation cache: hit rate = {:.3f} ({}/{}), memory = {:.1f} MB'.format(
+            self.get_hit_rate(), self.num_hits, self.num_lookups, self.get_memory_usage() / 2**20))
+
+
+class ClockStore():
+    """
+    Fixed-size key/value tensor store with CLOCK (second-chance) eviction. Keys are looked up through a
+    sorted copy of the slot keys; empty slots hold key -1.
+    """
+    def __init__(self, capacity, device):
+        self.capacity = capacity
+        self.keys = torch.full((capacity,), -1, dtype=torch.long, device=device)
+        self.sorted_keys, self.sorted_slots = torch.sort(self.keys)
+        self.ref_bits = torch.zeros(capacity, dtype=torch.bool, device=device)
+        self.values = None
+        self.hand = 0
+
+    def find(self, keys):
+        pos = torch.searchsorted(self.sorted_keys, keys).clamp(max=self.capacity - 1)
+        found = (self.sorted_keys[pos] == keys)
+        return self.sorted_slots[pos], found
+
+    def get(self, slots):
+        self.ref_bits[slots] = True
+        return self.values[slots]
+
+    def insert(self, keys, values):
+        if self.values is None:
+            self.values = values.new_zeros(self.capacity, values.size(1))
+        if len(keys) > self.capacity:
+            keys, values = keys[-self.capacity:], values[-self.capacity:]
+        num_victims = len(keys)
+        if num_victims == 0:
+            return
+        # Sweep the clock hand: take the unreferenced slots in clock order and, if there are not enough of
+        # them, complete a full turn (clearing all reference bits) and take the next slots in order
+        order = (torch.arange(self.capacity, device=keys.device) + self.hand) % self.capacity
+        ref_bits = self.ref_bits[order]
+        unref_pos = (~ref_bits).nonzero().view(-1)
+        if len(unref_pos) >= num_victims:
+            victim_pos = unref_pos[:num_victims]
+            last_pos = int(victim_pos[-1])
+            self.ref_bits[order[:last_pos + 1]] = False
+        else:
+            ref_pos = ref_bits.nonzero().view(-1)[:num_victims - len(unref_pos)]
+            victim_pos = torch.cat([unref_pos, ref_pos])
+            last_pos = int(ref_pos[-1])
+            self.ref_bits[:] = False
+        self.hand = (self.hand + last_pos + 1) % self.capacity
+        victims = order[victim_pos]
+        self.keys[victims] = keys
+        self.values[victims] = values
+        self.sorted_keys, self.sorted_slots = torch.sort(self.keys)
 
+    def get_memory_usage(self):
+        num_bytes = (self.keys.numel() + self.sorted_keys.numel() + self.sorted_slots.numel()) * 8
+        num_bytes += self.ref_bits.numel()
+        if self.values is not None:
+            num_bytes += self.values.numel() * self.values.element_size()
+        return num_bytes
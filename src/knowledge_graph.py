@@ -9,7 +9,7 @@
  Knowledge Graph Environment.
 """
 
-import collections
+import numpy as np
 import os
 import pickle
 
@@ -17,7 +17,8 @@ import torch
 import torch.nn as nn
 
 from src.data_utils import load_index
-from src.data_utils import load_aux_graph
+from src.data_utils import add_aux_edges, add_entities, load_aux_graph, load_triple_ids
+from src.data_utils import CSRAdjacency, load_page_rank_scores
 from src.data_utils import NO_OP_ENTITY_ID, NO_OP_RELATION_ID
 from src.data_utils import DUMMY_ENTITY_ID, DUMMY_RELATION_ID
 from src.data_utils import START_RELATION_ID
@@ -25,6 +26,85 @@ import src.utils.ops as ops
 from src.utils.ops import int_var_cuda, var_cuda
 
 
+class AnswerIndex():
+    """
+    Compressed index of the answers to (e1, r) queries.
+
+    The query (e1, r) is identified by the key e1 * num_relations + r. keys holds the sorted keys of the
+    queries in the index and the answers to query keys[i] are answers[offsets[i]:offsets[i + 1]], sorted
+    in increasing order. pair_keys holds the sorted (query, answer) keys key * num_entities + e2 used for
+    batched membership tests. The index is kept both on the host (for per-example lookups) and on the GPU
+    (for batched lookups).
+    """
+    def __init__(self, e1, r, e2, num_entities, num_relations):
+        """
+        :param e1, r, e2: integer numpy arrays of query entities, query relations and answers.
+        """
+        self.num_entities = num_entities
+        self.num_relations = num_relations
+        pair_keys = np.unique((np.asarray(e1, dtype=np.int64) * num_relations + np.asarray(r, dtype=np.int64))
+                              * num_entities + np.asarray(e2, dtype=np.int64))
+        query_keys = pair_keys // num_entities
+        keys, starts = np.unique(query_keys, return_index=True)
+        self._keys = keys
+        self._offsets = np.concatenate([starts, [len(pair_keys)]])
+        self._answers = pair_keys % num_entities
+        self.keys = int_var_cuda(torch.from_numpy(self._keys))
+        self.offsets = int_var_cuda(torch.from_numpy(self._offsets))
+        self.answers = int_var_cuda(torch.from_numpy(self._answers))
+        self.pair_keys = int_var_cuda(torch.from_numpy(pair_keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, e1, r):
+        """
+        :return: sorted numpy array of the answers to the query (e1, r) (empty if the query is not indexed).
+        """
+        key = e1 * self.num_relations + r
+        i = np.searchsorted(self._keys, key)
+        if i == len(self._keys) or self._keys[i] != key:
+            return self._answers[:0]
+        return self._answers[self._offsets[i]:self._offsets[i + 1]]
+
+    def answers_of(self, e1, r):
+        """
+        Batched answer lookup.
+        :param e1: (Variable:batch) query entities.
+        :param r: (Variable:batch) query relations.
+        :return answers: [batch_size, max_num_answers] answers of each query, padded with -1.
+        :return mask: [batch_size, max_num_answers] binary mask indicating the valid answers.
+        """
+        if len(self._keys) == 0:
+            mask = torch.zeros(len(e1), 1, dtype=torch.bool, device=e1.device)
+            return torch.full((len(e1), 1), -1, dtype=torch.long, device=e1.device), mask
+        query_keys = e1 * self.num_relations + r
+        i = torch.searchsorted(self.keys, query_keys).clamp(max=len(self._keys) - 1)
+        found = (self.keys[i] == query_keys)
+        start = self.offsets[i]
+        num_answers = (self.offsets[i + 1] - start) * found.long()
+        max_num_answers = max(int(num_answers.max()), 1)
+        column = torch.arange(max_num_answers, device=e1.device).unsqueeze(0)
+        mask = column < num_answers.unsqueeze(1)
+        answers = self.answers[(start.unsqueeze(1) + column) * mask.long()]
+        return answers.masked_fill(~mask, -1), mask
+
+    def contains(self, e1, r, e2):
+        """
+        Batched membership test.
+        :param e1: (Variable:batch) query entities.
+        :param r: (Variable:batch) query relations.
+        :param e2: (Variable:batch x k) candidate answers.
+        :return: [batch_size, k] binary mask indicating which candidates are answers to the queries.
+        """
+        query_keys = e1 * self.num_relations + r
+        pair_keys = query_keys.unsqueeze(1) * self.num_entities + e2
+        if len(self.pair_keys) == 0:
+            return torch.zeros_like(pair_keys, dtype=torch.bool)
+        i = torch.searchsorted(self.pair_keys, pair_keys).clamp(max=len(self.pair_keys) - 1)
+        return self.pair_keys[i] == pair_keys
+
+
 class KnowledgeGraph(nn.Module):
     """
     The discrete knowledge graph is stored with an adjacency list.
@@ -42,6 +122,8 @@ class KnowledgeGraph(nn.Module):
 
         self.action_space = None
         self.action_space_buckets = None
+        self.entity2bucketid = None
+        self.num_bucket_keys = None
         self.unique_r_space = None
 
         self.train_subjects = None
@@ -50,12 +132,6 @@ class KnowledgeGraph(nn.Module):
         self.dev_objects = None
         self.all_subjects = None
         self.all_objects = None
-        self.train_subject_vectors = None
-        self.train_object_vectors = None
-        self.dev_subject_vectors = None
-        self.dev_object_vectors = None
-        self.all_subject_vectors = None
-        self.all_object_vectors = None
 
         print('** Create {} knowledge graph **'.format(args.model))
         self.load_graph_data(args.data_dir)
@@ -90,9 +166,11 @@ class KnowledgeGraph(nn.Module):
         # Load graph structures
         if self.args.model.startswith('point'): 
             # Base graph structure used for training and test
-            adj_list_path = os.path.join(data_dir, 'adj_list.pkl')
-            with open(adj_list_path, 'rb') as f:
-                self.adj_list = pickle.load(f)
+            if self.args.inference:
+                self.entity2id_aug, self.id2entity_aug, self.adj_list = load_aux_graph(data_dir)
+            else:
+                self.adj_list = CSRAdjacency.load(data_dir)
+            print('Sanity check: {} seen+unseen entities loaded'.format(len(self.entity2id_aug)))
             self.vectorize_action_space(data_dir)
         else:
             if self.args.inference:
@@ -103,67 +181,65 @@ class KnowledgeGraph(nn.Module):
         """
         Pre-process and numericalize the knowledge graph structure.
         """
-        def load_page_rank_scores(input_path):
-            pgrk_scores = collections.defaultdict(float)
-            with open(input_path, encoding='utf-8') as f:
-                for line in f:
-                    e, score = line.strip().split(':')
-                    e = e.strip()
-                    if e in self.entity2id:
-                        e_id = self.entity2id[e]
-                        score = float(score)
-                        pgrk_scores[e_id] = score
-            return pgrk_scores
+        # Sanity check
+        print("Sanity check: maximum out degree: {}".format(self.adj_list.get_degrees().max()))
+        print('Sanity check: {} facts in knowledge graph'.format(self.adj_list.num_facts))
 
         if self.args.inference:
-            self.entity2id_aug, self.id2entity_aug, self.adj_list = load_aux_graph(data_dir)
-        print('Sanity check: {} seen+unseen entities loaded'.format(len(self.entity2id_aug)))
-
-        # Sanity check
-        num_facts = 0
-        out_degrees = collections.defaultdict(int)
-        for e1 in self.adj_list:
-            for r in self.adj_list[e1]:
-                num_facts += len(self.adj_list[e1][r])
-                out_degrees[e1] += len(self.adj_list[e1][r])
-        print("Sanity check: maximum out degree: {}".format(max(out_degrees.values())))
-        print('Sanity check: {} facts in knowledge graph'.format(num_facts))
+            num_entities = self.num_aug_entities
+        else:
+            num_entities = self.num_entities
 
         # load page rank scores
-        page_rank_scores = load_page_rank_scores(os.path.join(data_dir, 'raw.pgrk'))
-        
-        def get_action_space(e1):
-            action_space = []
-            if e1 in self.adj_list:
-                for r in self.adj_list[e1]:
-                    targets = self.adj_list[e1][r]
-                    for e2 in targets:
-                        action_space.append((r, e2))
-                if len(action_space) + 1 >= self.bandwidth:
-                    # Base graph pruning
-                    sorted_action_space = \
-                        sorted(action_space, key=lambda x: page_rank_scores[x[1]] if x[1] in page_rank_scores else 0, reverse=True)
-                    action_space = sorted_action_space[:self.bandwidth]
-            action_space.insert(0, (NO_OP_RELATION_ID, e1))
-            return action_space
+        page_rank_scores = load_page_rank_scores(os.path.join(data_dir, 'raw.pgrk'), self.entity2id,
+                                                 max(self.adj_list.num_nodes, num_entities))
+
+        def get_action_edges():
+            """
+            Select the actions of each entity from the flat edge list. Entities with at least
+            bandwidth - 1 facts are pruned to the self.bandwidth facts with the highest PageRank score
+            of the target entity, ties broken by the order of the facts.
+            :return e1, r, e2: the selected facts.
+            :return column: action space index of each selected fact (index 0 is the NO_OP action).
+            :return action_space_sizes: action space size of each entity, including the NO_OP action.
+            """
+            e1, r, e2 = self.adj_list.get_edges()
+            in_range = (e1 < num_entities)
+            e1, r, e2 = e1[in_range], r[in_range].astype(np.int64), e2[in_range].astype(np.int64)
+            degrees = np.bincount(e1, minlength=num_entities)
+            offsets = np.concatenate([[0], np.cumsum(degrees)])
+            position = np.arange(len(e1)) - offsets[e1]
+            # Base graph pruning
+            is_pruned = (degrees + 1 >= self.bandwidth)[e1]
+            scores = np.where(is_pruned, page_rank_scores[e2], 0)
+            order = np.lexsort((position, -scores, e1))
+            e1, r, e2 = e1[order], r[order], e2[order]
+            rank = np.arange(len(e1)) - offsets[e1]
+            is_selected = (rank < self.bandwidth)
+            action_space_sizes = np.minimum(degrees, self.bandwidth) + 1
+            return e1[is_selected], r[is_selected], e2[is_selected], rank[is_selected] + 1, action_space_sizes
 
         def get_unique_r_space(e1):
-            if e1 in self.adj_list:
-                return list(self.adj_list[e1].keys())
-            else:
-                return []
-
-        def vectorize_action_space(action_space_list, action_space_size):
-            bucket_size = len(action_space_list)
-            r_space = torch.zeros(bucket_size, action_space_size) + self.dummy_r
-            e_space = torch.zeros(bucket_size, action_space_size) + self.dummy_e
-            action_mask = torch.zeros(bucket_size, action_space_size)
-            for i, action_space in enumerate(action_space_list):
-                for j, (r, e) in enumerate(action_space):
-                    r_space[i, j] = r
-                    e_space[i, j] = e
-                    action_mask[i, j] = 1
-            return (int_var_cuda(r_space), int_var_cuda(e_space)), var_cuda(action_mask)
+            return self.adj_list.get_unique_relations(e1).tolist()
+
+        def vectorize_action_space(entities, rows, r, e, column, action_space_size):
+            """
+            Build the action space table of a set of entities.
+            :param entities: the entities of the table rows.
+            :param rows, r, e, column: table row, relation, target entity and column of each selected fact.
+            """
+            bucket_size = len(entities)
+            r_space = np.full((bucket_size, action_space_size), self.dummy_r, dtype=np.int64)
+            e_space = np.full((bucket_size, action_space_size), self.dummy_e, dtype=np.int64)
+            action_mask = np.zeros((bucket_size, action_space_size), dtype=np.float32)
+            r_space[:, 0] = NO_OP_RELATION_ID
+            e_space[:, 0] = entities
+            action_mask[:, 0] = 1
+            r_space[rows, column] = r
+            e_space[rows, column] = e
+            action_mask[rows, column] = 1
+            return (int_var_cuda(torch.from_numpy(r_space)), int_var_cuda(torch.from_numpy(e_space))), \
+                var_cuda(torch.from_numpy(action_mask))
 
         def vectorize_unique_r_space(unique_r_space_list, unique_r_space_size, volatile):
             bucket_size = len(unique_r_space_list)
@@ -173,47 +249,43 @@ class KnowledgeGraph(nn.Module):
                     unique_r_space[i, j] = r
             return int_var_cuda(unique_r_space)
 
-        if self.args.inference:
-            num_entities = self.num_aug_entities
-        else:
-            num_entities = self.num_entities
-
+        e1, r, e2, column, action_space_sizes = get_action_edges()
         if self.args.use_action_space_bucketing:
             """
             Store action spaces in buckets.
             """
             self.action_space_buckets = {}
-            action_space_buckets_discrete = collections.defaultdict(list)
-            self.entity2bucketid = torch.zeros(num_entities, 2).long()
-            num_facts_saved_in_action_table = 0
-            for e1 in range(num_entities):
-                action_space = get_action_space(e1)
-                key = int(len(action_space) / self.args.bucket_interval) + 1
-                self.entity2bucketid[e1, 0] = key
-                self.entity2bucketid[e1, 1] = len(action_space_buckets_discrete[key])
-                action_space_buckets_discrete[key].append(action_space)
-                num_facts_saved_in_action_table += len(action_space)
-            print('Sanity check: {} facts saved in action table'.format(
-                num_facts_saved_in_action_table - num_entities))
-            for key in action_space_buckets_discrete:
+            bucket_keys = action_space_sizes // self.args.bucket_interval + 1
+            # Entities are assigned to buckets in increasing id order and buckets are created in order of
+            # their first entity
+            order = np.argsort(bucket_keys, kind='stable')
+            sorted_keys = bucket_keys[order]
+            _, bucket_starts = np.unique(sorted_keys, return_index=True)
+            bucket_starts = np.concatenate([bucket_starts, [num_entities]])
+            bucket_ids = np.zeros(num_entities, dtype=np.int64)
+            bucket_ids[order] = np.arange(num_entities) - np.repeat(bucket_starts[:-1], np.diff(bucket_starts))
+            self.entity2bucketid = int_var_cuda(torch.from_numpy(np.stack([bucket_keys, bucket_ids], axis=1)))
+            self.num_bucket_keys = int(bucket_keys.max()) + 1
+            print('Sanity check: {} facts saved in action table'.format(len(e1)))
+            bucket_order = np.argsort(order[bucket_starts[:-1]])
+            edge_keys = bucket_keys[e1]
+            for i in bucket_order.tolist():
+                key = int(sorted_keys[bucket_starts[i]])
+                entities = order[bucket_starts[i]:bucket_starts[i + 1]]
+                in_bucket = (edge_keys == key)
                 print('Vectorizing action spaces bucket {}...'.format(key))
                 self.action_space_buckets[key] = vectorize_action_space(
-                    action_space_buckets_discrete[key], key * self.args.bucket_interval)
+                    entities, bucket_ids[e1[in_bucket]], r[in_bucket], e2[in_bucket], column[in_bucket],
+                    key * self.args.bucket_interval)
         else:
-            action_space_list = []
-            max_num_actions = 0
-            for e1 in range(num_entities):
-                action_space = get_action_space(e1)
-                action_space_list.append(action_space)
-                if len(action_space) > max_num_actions:
-                    max_num_actions = len(action_space)
             print('Vectorizing action spaces...')
-            self.action_space = vectorize_action_space(action_space_list, max_num_actions)
+            self.action_space = vectorize_action_space(
+                np.arange(num_entities), e1, r, e2, column, int(action_space_sizes.max()))
             
             if self.args.model.startswith('rule'):
                 unique_r_space_list = []
                 max_num_unique_rs = 0
-                for e1 in sorted(self.adj_list.keys()):
+                for e1 in self.adj_list.get_source_entities().tolist():
                     unique_r_space = get_unique_r_space(e1)
                     unique_r_space_list.append(unique_r_space)
                     if len(unique_r_space) > max_num_unique_rs:
@@ -221,87 +293,38 @@ class KnowledgeGraph(nn.Module):
                 self.unique_r_space = vectorize_unique_r_space(unique_r_space_list, max_num_unique_rs)
 
     def load_all_answers(self, data_dir, add_reversed_edges=False):
-        def add_subject(e1, e2, r, d):
-            if not e2 in d:
-                d[e2] = {}
-            if not r in d[e2]:
-                d[e2][r] = set()
-            d[e2][r].add(e1)
-
-        def add_object(e1, e2, r, d):
-            if not e1 in d:
-                d[e1] = {}
-            if not r in d[e1]:
-                d[e1][r] = set()
-            d[e1][r].add(e2)
-
         # store subjects for all (rel, object) queries and
         # objects for all (subject, rel) queries
-        train_subjects, train_objects = {}, {}
-        dev_subjects, dev_objects = {}, {}
-        all_subjects, all_objects = {}, {}
         # include dummy examples
-        add_subject(self.dummy_e, self.dummy_e, self.dummy_r, train_subjects)
-        add_subject(self.dummy_e, self.dummy_e, self.dummy_r, dev_subjects)
-        add_subject(self.dummy_e, self.dummy_e, self.dummy_r, all_subjects)
-        add_object(self.dummy_e, self.dummy_e, self.dummy_r, train_objects)
-        add_object(self.dummy_e, self.dummy_e, self.dummy_r, dev_objects)
-        add_object(self.dummy_e, self.dummy_e, self.dummy_r, all_objects)
+        dummy_triples = np.array([[self.dummy_e, self.dummy_e, self.dummy_r]], dtype=np.int64)
+        train_triples, dev_triples, all_triples = [dummy_triples], [dummy_triples], [dummy_triples]
         for file_name in ['raw.kb', 'train.triples', 'dev.triples']:
             if 'NELL' in self.args.data_dir and self.args.test and file_name == 'train.triples':
                 continue
-            with open(os.path.join(data_dir, file_name), encoding='utf-8') as f:
-                for line in f:
-                    e1, e2, r = line.strip().split()
-                    e1, e2, r = self.triple2ids((e1, e2, r))
-                    if file_name in ['raw.kb', 'train.triples']:
-                        add_subject(e1, e2, r, train_subjects)
-                        add_object(e1, e2, r, train_objects)
-                        if add_reversed_edges:
-                            add_subject(e2, e1, self.get_inv_relation_id(r), train_subjects)
-                            add_object(e2, e1, self.get_inv_relation_id(r), train_objects)
-                    if file_name in ['raw.kb', 'train.triples', 'dev.triples']:
-                        add_subject(e1, e2, r, dev_subjects)
-                        add_object(e1, e2, r, dev_objects)
-                        if add_reversed_edges:
-                            add_subject(e2, e1, self.get_inv_relation_id(r), dev_subjects)
-                            add_object(e2, e1, self.get_inv_relation_id(r), dev_objects)
-                    add_subject(e1, e2, r, all_subjects)
-                    add_object(e1, e2, r, all_objects)
-                    if add_reversed_edges:
-                        add_subject(e2, e1, self.get_inv_relation_id(r), all_subjects)
-                        add_object(e2, e1, self.get_inv_relation_id(r), all_objects)
+            triples = load_triple_ids(
+                os.path.join(data_dir, file_name), self.entity2id, self.relation2id).astype(np.int64)
+            if add_reversed_edges:
+                inv_triples = np.stack([triples[:, 1], triples[:, 0], self.get_inv_relation_id(triples[:, 2])], axis=1)
+                triples = np.concatenate([triples, inv_triples])
+            if file_name in ['raw.kb', 'train.triples']:
+                train_triples.append(triples)
+            dev_triples.append(triples)
+            all_triples.append(triples)
 
         if self.args.inference:
-            with open(os.path.join(data_dir, 'test.triples'), encoding='utf-8') as f:
-                for line in f:
-                    e1, e2, r = line.strip().split()
-                    e1, e2, r = self.triple2ids_aug((e1, e2, r))
-                    add_subject(e1, e2, r, all_subjects)
-                    add_object(e1, e2, r, all_objects)
-
-        self.train_subjects = train_subjects
-        self.train_objects = train_objects
-        self.dev_subjects = dev_subjects
-        self.dev_objects = dev_objects
-        self.all_subjects = all_subjects
-        self.all_objects = all_objects
-       
-        # change the answer set into a variable
-        def answers_to_var(d_l):
-            d_v = collections.defaultdict(collections.defaultdict)
-            for x in d_l:
-                for y in d_l[x]:
-                    v = torch.LongTensor(list(d_l[x][y])).unsqueeze(1)
-                    d_v[x][y] = int_var_cuda(v)
-            return d_v
-        
-        self.train_subject_vectors = answers_to_var(train_subjects)
-        self.train_object_vectors = answers_to_var(train_objects)
-        self.dev_subject_vectors = answers_to_var(dev_subjects)
-        self.dev_object_vectors = answers_to_var(dev_objects)
-        self.all_subject_vectors = answers_to_var(all_subjects)
-        self.all_object_vectors = answers_to_var(all_objects)
+            all_triples.append(load_triple_ids(
+                os.path.join(data_dir, 'test.triples'), self.entity2id_aug, self.relation2id).astype(np.int64))
+
+        num_entities = max(self.num_entities, self.num_aug_entities)
+        def get_answer_indices(triples_list):
+            triples = np.concatenate(triples_list)
+            e1, e2, r = triples[:, 0], triples[:, 1], triples[:, 2]
+            return AnswerIndex(e2, r, e1, num_entities, self.num_relations), \
+                   AnswerIndex(e1, r, e2, num_entities, self.num_relations)
+
+        self.train_subjects, self.train_objects = get_answer_indices(train_triples)
+        self.dev_subjects, self.dev_objects = get_answer_indices(dev_triples)
+        self.all_subjects, self.all_objects = get_answer_indices(all_triples)
 
     def load_fuzzy_facts(self):
         # extend current adjacency list with fuzzy facts
@@ -314,7 +337,7 @@ class KnowledgeGraph(nn.Module):
         removed_triples = set(dev_triples + test_triples)
         theta = 0.5
         fuzzy_fact_path = os.path.join(self.args.data_dir, 'train.fuzzy.triples')
-        count = 0
+        e1_ids, r_ids, e2_ids = [], [], []
         with open(fuzzy_fact_path, encoding='utf-8') as f:
             for line in f:
                 e1, e2, r, score = line.strip().split()
@@ -324,18 +347,35 @@ class KnowledgeGraph(nn.Module):
                 print(line)
                 if '{}\t{}\t{}'.format(e1, e2, r) in removed_triples:
                     continue
-                e1_id = self.entity2id[e1]
-                e2_id = self.entity2id[e2]
-                r_id = self.relation2id[r]
-                if not r_id in self.adj_list[e1_id]:
-                    self.adj_list[e1_id][r_id] = set()
-                if not e2_id in self.adj_list[e1_id][r_id]:
-                    self.adj_list[e1_id][r_id].add(e2_id)
-                    count += 1
-                    if count > 0 and count % 1000 == 0:
-                        print('{} fuzzy facts added'.format(count))
+                e1_ids.append(self.entity2id[e1])
+                r_ids.append(self.relation2id[r])
+                e2_ids.append(self.entity2id[e2])
+        num_facts = self.adj_list.num_facts
+        self.adj_list = self.adj_list.add_edges(e1_ids, r_ids, e2_ids)
+        print('{} fuzzy facts added'.format(self.adj_list.num_facts - num_facts))
+
+        self.vectorize_action_space(self.args.data_dir)
+
+    def add_aux_triples(self, triples):
+        """
+        Index the unseen entities of aux triples, connect them to the seen entities they are linked to and
+        rebuild the action space. Only used in inference mode; the triples are not written to aux.triples.
+        :param triples: List of (e1, e2, r) entity and relation names.
+        :return: Number of entities added to the augmented entity index.
+        """
+        assert (self.args.inference)
+        num_entities_added = add_entities(self.entity2id_aug, self.id2entity_aug,
+                                          [e for e1, e2, _ in triples for e in (e1, e2)])
+        num_facts = self.adj_list.num_facts
+        self.adj_list = add_aux_edges(self.adj_list, [self.triple2ids_aug(triple) for triple in triples],
+                                      self.num_entities, self.num_aug_entities, self.relation2id, self.id2relation)
+        print('{} aux entities and {} aux facts added'.format(num_entities_added, self.adj_list.num_facts - num_facts))
 
         self.vectorize_action_space(self.args.data_dir)
+        if num_entities_added > 0:
+            # the (query, answer) keys of the answer indices are based on the number of entities
+            self.load_all_answers(self.args.data_dir)
+        return num_entities_added
 
     def get_inv_relation_id(self, r_id):
         return r_id + 1
@@ -138,17 +138,23 @@ class LFramework(nn.Module):
                 num_fns = float(fns.sum())
                 fn_ratio = num_fns / len(fns)
                 print('* Analysis: false negative ratio = {}'.format(fn_ratio))
+                if self.model.startswith('point'):
+                    dedup_ratios = ['{:.3f}'.format(x) for x in self.mdl.get_dedup_ratios()]
+                    print('* Analysis: unique (entity, query) ratio per step = {}'.format(dedup_ratios))
+                    self.mdl.graph_transformer.print_attention_stats()
+            if self.model.startswith('point'):
+                self.mdl.action_mask_validator.print_stats()
 
             # Check dev set performance
             if self.run_analysis or (epoch_id > 0 and epoch_id % self.num_peek_epochs == 0):
                 self.eval()
                 self.batch_size = self.dev_batch_size
-                dev_scores = self.forward(dev_data, verbose=False)
+                dev_metrics, all_metrics = self.evaluate(dev_data, [self.kg.dev_objects, self.kg.all_objects])
                 print('Dev set performance: (correct evaluation)')
-                _, _, _, _, mrr = src.eval.hits_and_ranks(dev_data, dev_scores, self.kg.dev_objects, verbose=True)
-                metrics = mrr
+                src.eval.print_metrics(dev_metrics)
+                metrics = dev_metrics[4]
                 print('Dev set performance: (include test set labels)')
-                src.eval.hits_and_ranks(dev_data, dev_scores, self.kg.all_objects, verbose=True)
+                src.eval.print_metrics(all_metrics)
                 # Action dropout anneaking
                 if self.model.startswith('point'):
                     eta = self.action_dropout_anneal_interval
@@ -201,9 +207,55 @@ class LFramework(nn.Module):
                 self.make_full_batch(mini_batch, self.batch_size)
             pred_score = self.predict(mini_batch, verbose=verbose)
             pred_scores.append(pred_score[:mini_batch_size])
-        scores = torch.cat(pred_scores)
+        if isinstance(pred_scores[0], ops.TopKScores):
+            scores = ops.TopKScores.cat(pred_scores)
+        else:
+            scores = torch.cat(pred_scores)
         return scores
 
+    def evaluate(self, examples, all_answers_list, verbose=False):
+        """
+        Compute the filtered ranking metrics of the examples batch by batch, without keeping the
+        prediction scores of the whole set in memory.
+        :param examples: List of (e1, e2, r) triples.
+        :param all_answers_list: List of answer indices to filter the predictions with.
+        :return: List of (Hits@1, Hits@3, Hits@5, Hits@10, MRR), one per answer index.
+        """
+        metrics_list = self.evaluate_slices(examples, all_answers_list, verbose=verbose)
+        return [metrics.get_metrics() for metrics in metrics_list]
+
+    def evaluate_slices(self, examples, all_answers_list, relation_by_types=None, seen_queries=None,
+                        verbose=False):
+        """
+        Compute the overall and the sliced ranking metrics of the examples for every answer index with a
+        single prediction pass.
+        :param examples: List of (e1, e2, r) triples.
+        :param all_answers_list: List of answer indices to filter the predictions with.
+        :param relation_by_types: (to-M relations, to-1 relations) used to slice the examples.
+        :param seen_queries: Set of (e1, r) queries seen in training used to slice the examples.
+        :return: List of src.eval.SliceMetrics, one per answer index.
+        """
+        metrics_list = [src.eval.SliceMetrics(relation_by_types, seen_queries) for _ in all_answers_list]
+        if self.model.startswith('point'):
+            self.mdl.get_dedup_ratios('eval', reset=True)
+        for example_id in tqdm(range(0, len(examples), self.batch_size)):
+            mini_batch = examples[example_id:example_id + self.batch_size]
+            mini_batch_size = len(mini_batch)
+            if len(mini_batch) < self.batch_size:
+                self.make_full_batch(mini_batch, self.batch_size)
+            pred_score = self.predict(mini_batch, verbose=verbose)[:mini_batch_size]
+            mini_batch = mini_batch[:mini_batch_size]
+            for metrics, all_answers in zip(metrics_list, all_answers_list):
+                metrics.update(mini_batch, src.eval.filtered_ranks(mini_batch, pred_score, all_answers))
+        if self.model.startswith('point'):
+            dedup_ratios = ['{:.3f}'.format(x) for x in self.mdl.get_dedup_ratios('eval')]
+            print('Beam search: unique (entity, query) ratio per step = {}'.format(dedup_ratios))
+            if self.mdl.entity_cache is not None:
+                self.mdl.entity_cache.print_stats()
+            if self.run_analysis:
+                self.mdl.graph_transformer.print_attention_stats()
+        return metrics_list
+
     def format_batch(self, batch_data, num_labels=-1, num_tiles=1):
         """
         Convert batched tuples to the tensors accepted by the NN.
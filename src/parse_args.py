@@ -20,6 +20,8 @@ parser.add_argument('--train', action='store_true',
                     help='run path selection set_policy training (default: False)')
 parser.add_argument('--inference', action='store_true',
                     help='run knowledge graph inference (default: False)')
+parser.add_argument('--serve', action='store_true',
+                    help='serve link prediction queries with a trained model over HTTP (default: False)')
 parser.add_argument('--search_random_seed', action='store_true',
                     help='run experiments with multiple random initializations and compute the result statistics '
                          '(default: False)')
@@ -182,6 +184,32 @@ parser.add_argument('--bandwidth', type=int, default=300,
                     help='maximum number of outgoing edges to explore at each step (default: 300)')
 parser.add_argument('--r_bandwidth', type=int, default=10,
                     help='maximum number of unique relation types connecting a pair of entities (default: 10)')
+parser.add_argument('--dedup_train_entities', action='store_true',
+                    help='encode every unique (entity, query) pair of the training rollouts once with the graph '
+                         'transformer instead of every rollout, sharing the neighbor samples and neighbor dropout '
+                         'masks of the rollouts at the same entity (default: False)')
+parser.add_argument('--eval_neighbor_selection', type=str, default='random', choices=['random', 'pagerank'],
+                    help='how the graph transformer selects `bandwidth` neighbors of entities with more neighbors '
+                         'than that in eval mode: random samples or the neighbors with the highest PageRank scores. '
+                         'pagerank precomputes the selections of every such entity and query relation, which takes '
+                         '4 * bandwidth bytes per (entity, relation labeling one of its edges) pair in device memory '
+                         '(default: random)')
+parser.add_argument('--padded_neighbor_attention', action='store_true',
+                    help='run the graph transformer attention over the neighbor lists padded to `bandwidth` instead '
+                         'of the packed valid neighbors (default: False)')
+parser.add_argument('--entity_cache_size', type=int, default=0,
+                    help='number of graph transformer entity representations cached per graph in eval mode, '
+                         'requires --eval_neighbor_selection pagerank (default: 0, no caching)')
+parser.add_argument('--dense_action_scoring', action='store_true',
+                    help='score the actions against the full [batch, action_space_size, action_dim] action embeddings '
+                         'instead of factorized relation and entity scores (default: False)')
+parser.add_argument('--action_mask_validation', type=str, default='off', choices=['off', 'sampled', 'strict'],
+                    help='check that the action masks only contain 0s and 1s: never, in 1 out of '
+                         '`action_mask_validation_period` steps counting the invalid rows, or in every step failing '
+                         'on the first invalid mask (default: off)')
+parser.add_argument('--action_mask_validation_period', type=int, default=100,
+                    help='number of transition steps between two action mask checks in sampled validation mode '
+                         '(default: 100)')
 parser.add_argument('--num_paths_per_entity', type=int, default=3,
                     help='number of paths used to calculate entity potential (default: 3)')
 parser.add_argument('--beta', type=float, default=0.0,
@@ -221,6 +249,31 @@ parser.add_argument('--export_error_cases', action='store_true',
 parser.add_argument('--compute_map', action='store_true',
                     help='compute the Mean Average Precision evaluation metrics (default: False)')
 
+# Link Prediction Server
+parser.add_argument('--serve_host', type=str, default='127.0.0.1',
+                    help='host the link prediction server listens on (default: 127.0.0.1)')
+parser.add_argument('--serve_port', type=int, default=8000,
+                    help='port the link prediction server listens on (default: 8000)')
+parser.add_argument('--serve_socket', type=str, default=None,
+                    help='serve on this Unix socket instead of the host and port (default: None)')
+parser.add_argument('--serve_batch_size', type=int, default=64,
+                    help='maximum number of queries answered in one mini-batch (default: 64)')
+parser.add_argument('--serve_max_latency', type=float, default=10,
+                    help='maximum number of milliseconds a query waits for other queries to fill its mini-batch '
+                         '(default: 10)')
+
+# Batch Inference
+parser.add_argument('--predict_input', type=str, default=None,
+                    help='write the top-k predictions and paths of the "e1\\tr" queries or "e1\\te2\\tr" triples in this file '
+                         'to --predict_output (default: None)')
+parser.add_argument('--predict_output', type=str, default=None,
+                    help='output file (jsonl) or directory (columnar) of the batch predictions (default: None)')
+parser.add_argument('--predict_output_format', type=str, default='jsonl', choices=['jsonl', 'columnar'],
+                    help='format of the batch predictions: one JSON object per query or a directory of binary columns '
+                         '(default: jsonl)')
+parser.add_argument('--predict_top_k', type=int, default=10,
+                    help='number of predictions written per query (default: 10)')
+
 # Hyperparameter Search
 parser.add_argument('--tune', type=str, default='',
                     help='Specify the hyperparameters to tune during the search, separated by commas (default: None)')
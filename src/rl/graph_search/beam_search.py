@@ -10,7 +10,7 @@
 import torch
 
 import src.utils.ops as ops
-from src.utils.ops import unique_max, var_cuda, zeros_var_cuda, int_var_cuda, int_fill_var_cuda, var_to_numpy
+from src.utils.ops import zeros_var_cuda, int_var_cuda, int_fill_var_cuda, var_to_numpy
 
 
 def beam_search(pn, e_s, q, e_t, kg, num_steps, beam_size, return_path_components=False):
@@ -34,36 +34,27 @@ def beam_search(pn, e_s, q, e_t, kg, num_steps, beam_size, return_path_component
         Get top k actions.
             - k = beam_size if the beam size is smaller than or equal to the beam action space size
             - k = beam_action_space_size otherwise
-        :param log_action_dist: [batch_size*k, action_space_size]
-        :param action_space (r_space, e_space):
-            r_space: [batch_size*k, action_space_size]
-            e_space: [batch_size*k, action_space_size]
+        :param log_action_dist: [num_actions] packed log probabilities of the beam actions.
+        :param action_space: ops.RaggedActionSpace of the batch_size*k' beams.
         :return:
             (next_r, next_e), action_prob, action_offset: [batch_size*new_k]
         """
-        full_size = len(log_action_dist)
+        full_size = len(action_space)
         assert (full_size % batch_size == 0)
         last_k = int(full_size / batch_size)
 
-        (r_space, e_space), _ = action_space
-        action_space_size = r_space.size()[1]
-        # => [batch_size, k'*action_space_size]
-        log_action_dist = log_action_dist.view(batch_size, -1)
-        beam_action_space_size = log_action_dist.size()[1]
-        k = min(beam_size, beam_action_space_size)
+        k = min(beam_size, last_k * action_space.max_width)
         # [batch_size, k]
-        log_action_prob, action_ind = torch.topk(log_action_dist, k)
-        next_r = ops.batch_lookup(r_space.view(batch_size, -1), action_ind).view(-1)
-        next_e = ops.batch_lookup(e_space.view(batch_size, -1), action_ind).view(-1)
+        log_action_prob, action_ind, action_mask = ops.segment_top_k(
+            log_action_dist, action_space.row_ids // last_k, batch_size, k)
+        next_r = action_space.r_space[action_ind].masked_fill(~action_mask, kg.dummy_r).view(-1)
+        next_e = action_space.e_space[action_ind].masked_fill(~action_mask, kg.dummy_e).view(-1)
         # [batch_size, k] => [batch_size*k]
         log_action_prob = log_action_prob.view(-1)
         # *** compute parent offset
-        # [batch_size, k]
-        action_beam_offset = action_ind // action_space_size
-        # [batch_size, 1]
+        # padding actions continue from the first beam of their example
         action_batch_offset = int_var_cuda(torch.arange(batch_size) * last_k).unsqueeze(1)
-        # [batch_size, k] => [batch_size*k]
-        action_offset = (action_batch_offset + action_beam_offset).view(-1)
+        action_offset = torch.where(action_mask, action_space.row_ids[action_ind], action_batch_offset).view(-1)
         return (next_r, next_e), log_action_prob, action_offset
 
     def top_k_answer_unique(log_action_dist, action_space):
@@ -71,64 +62,40 @@ def beam_search(pn, e_s, q, e_t, kg, num_steps, beam_size, return_path_component
         Get top k unique entities
             - k = beam_size if the beam size is smaller than or equal to the beam action space size
             - k = beam_action_space_size otherwise
-        :param log_action_dist: [batch_size*beam_size, action_space_size]
-        :param action_space (r_space, e_space):
-            r_space: [batch_size*beam_size, action_space_size]
-            e_space: [batch_size*beam_size, action_space_size]
+        :param log_action_dist: [num_actions] packed log probabilities of the beam actions.
+        :param action_space: ops.RaggedActionSpace of the batch_size*beam_size beams.
         :return:
             (next_r, next_e), action_prob, action_offset: [batch_size*k]
         """
-        full_size = len(log_action_dist)
+        full_size = len(action_space)
         assert (full_size % batch_size == 0)
         last_k = int(full_size / batch_size)
-        (r_space, e_space), _ = action_space
-        action_space_size = r_space.size()[1]
 
-        r_space = r_space.view(batch_size, -1)
-        e_space = e_space.view(batch_size, -1)
-        log_action_dist = log_action_dist.view(batch_size, -1)
-        beam_action_space_size = log_action_dist.size()[1]
-        assert (beam_action_space_size % action_space_size == 0)
-        k = min(beam_size, beam_action_space_size)
-        next_r_list, next_e_list = [], []
-        log_action_prob_list = []
-        action_offset_list = []
-        for i in range(batch_size):
-            log_action_dist_b = log_action_dist[i]
-            r_space_b = r_space[i]
-            e_space_b = e_space[i]
-            unique_e_space_b = var_cuda(torch.unique(e_space_b.data.cpu()))
-            unique_log_action_dist, unique_idx = unique_max(unique_e_space_b, e_space_b, log_action_dist_b)
-            k_prime = min(len(unique_e_space_b), k)
-            top_unique_log_action_dist, top_unique_idx2 = torch.topk(unique_log_action_dist, k_prime)
-            top_unique_idx = unique_idx[top_unique_idx2]
-            top_unique_beam_offset = top_unique_idx // action_space_size
-            top_r = r_space_b[top_unique_idx]
-            top_e = e_space_b[top_unique_idx]
-            next_r_list.append(top_r.unsqueeze(0))
-            next_e_list.append(top_e.unsqueeze(0))
-            log_action_prob_list.append(top_unique_log_action_dist.unsqueeze(0))
-            top_unique_batch_offset = i * last_k
-            top_unique_action_offset = top_unique_batch_offset + top_unique_beam_offset
-            action_offset_list.append(top_unique_action_offset.unsqueeze(0))
-        next_r = ops.pad_and_cat(next_r_list, padding_value=kg.dummy_r).view(-1)
-        next_e = ops.pad_and_cat(next_e_list, padding_value=kg.dummy_e).view(-1)
-        log_action_prob = ops.pad_and_cat(log_action_prob_list, padding_value=-ops.HUGE_INT)
-        action_offset = ops.pad_and_cat(action_offset_list, padding_value=-1)
+        k = min(beam_size, last_k * action_space.max_width)
+        num_entities = int(action_space.e_space.max()) + 1 if len(action_space.e_space) > 0 else 1
+        # [batch_size, k]
+        log_action_prob, action_ind, action_mask = ops.segment_unique_top_k(
+            log_action_dist, action_space.e_space, action_space.row_ids // last_k, batch_size, k, num_entities)
+        # keep k' = the maximum number of distinct entities selected for an example
+        k_prime = max(int(action_mask.long().sum(dim=1).max()), 1)
+        log_action_prob = log_action_prob[:, :k_prime]
+        action_ind = action_ind[:, :k_prime]
+        action_mask = action_mask[:, :k_prime]
+        next_r = action_space.r_space[action_ind].masked_fill(~action_mask, kg.dummy_r).view(-1)
+        next_e = action_space.e_space[action_ind].masked_fill(~action_mask, kg.dummy_e).view(-1)
+        # *** compute parent offset
+        action_offset = action_space.row_ids[action_ind].masked_fill(~action_mask, -1)
         return (next_r, next_e), log_action_prob.view(-1), action_offset.view(-1)
     
-    def adjust_search_trace(search_trace, action_offset):
-        for i, (r, e) in enumerate(search_trace):
-            new_r = r[action_offset]
-            new_e = e[action_offset]
-            search_trace[i] = (new_r, new_e)
-
     # Initialization
     r_s = int_fill_var_cuda(e_s.size(), kg.dummy_start_r)
     seen_nodes = int_fill_var_cuda(e_s.size(), kg.dummy_e).unsqueeze(1)
     init_action = (r_s, e_s)
     # path encoder
     emb_e_s = pn.initialize_path(init_action, q, kg, 'eval')
+    # the search trace and the action log probabilities of each step are aligned with the final beams
+    # only once, by following the action offsets back from the last step
+    action_offsets = [None]
     if kg.args.save_beam_search_paths:
         search_trace = [(r_s, e_s)]
 
@@ -155,20 +122,19 @@ def beam_search(pn, e_s, q, e_t, kg, num_steps, beam_size, return_path_component
         db_outcomes, _, _ = pn.transit(
             e, obs, kg, 'eval', use_action_space_bucketing=True, merge_aspace_batching_outcome=True)
         action_space, action_dist = db_outcomes[0]
-        # => [batch_size*k, action_space_size]
-        log_action_dist = log_action_prob.view(-1, 1) + ops.safe_log(action_dist)
-        # [batch_size*k, action_space_size] => [batch_size*new_k]
+        # => [num_actions] packed over the batch_size*k beams
+        log_action_dist = log_action_prob[action_space.row_ids] + ops.safe_log(action_dist)
+        # [num_actions] => [batch_size*new_k]
         if t == num_steps - 1:
             action, log_action_prob, action_offset = top_k_answer_unique(log_action_dist, action_space)
         else:
             action, log_action_prob, action_offset = top_k_action(log_action_dist, action_space)
+        action_offsets.append(action_offset)
         if return_path_components:
-            ops.rearrange_vector_list(log_action_probs, action_offset)
             log_action_probs.append(log_action_prob)
         pn.update_path(action, kg, offset=action_offset)
         seen_nodes = torch.cat([seen_nodes[action_offset], action[1].unsqueeze(1)], dim=1)
         if kg.args.save_beam_search_paths:
-            adjust_search_trace(search_trace, action_offset)
             search_trace.append(action)
 
     output_beam_size = int(action[0].size()[0] / batch_size)
@@ -177,9 +143,11 @@ def beam_search(pn, e_s, q, e_t, kg, num_steps, beam_size, return_path_component
     beam_search_output['pred_e2s'] = action[1].view(batch_size, -1)
     beam_search_output['pred_e2_scores'] = log_action_prob.view(batch_size, -1)
     if kg.args.save_beam_search_paths:
+        search_trace = ops.backtrack_beam_trace(search_trace, action_offsets)
         beam_search_output['search_traces'] = search_trace
 
     if return_path_components:
+        log_action_probs = ops.backtrack_beam_trace(log_action_probs, action_offsets[1:])
         path_width = 10
         path_components_list = []
         for i in range(batch_size):
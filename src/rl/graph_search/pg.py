@@ -12,7 +12,7 @@ import torch
 from src.learn_framework import LFramework
 import src.rl.graph_search.beam_search as search
 import src.utils.ops as ops
-from src.utils.ops import int_fill_var_cuda, var_cuda, zeros_var_cuda
+from src.utils.ops import int_fill_var_cuda, var_cuda
 
 
 class PolicyGradient(LFramework):
@@ -94,7 +94,7 @@ class PolicyGradient(LFramework):
             fn = torch.zeros(final_reward.size())
             for i in range(len(final_reward)):
                 if not final_reward[i]:
-                    if int(pred_e2[i]) in self.kg.all_objects[int(e1[i])][int(r[i])]:
+                    if int(pred_e2[i]) in self.kg.all_objects.get(int(e1[i]), int(r[i])):
                         fn[i] = 1
             loss_dict['fn'] = fn
 
@@ -241,11 +241,62 @@ class PolicyGradient(LFramework):
                     print('e1 = {},r = {},e2 = {},beam {},score = {},<PATH> {}'.format(kg.id2entity_aug[int(e1[i].item())], kg.id2relation[int(r[i].item())], kg.id2entity_aug[int(e2[i].item())],
                         j, float(pred_e2_scores[i][j]), ops.format_path(search_trace, kg)))
         with torch.no_grad():
-            pred_scores = zeros_var_cuda([len(e1), kg.num_entities])
-            for i in range(len(e1)):
-                pred_scores[i][pred_e2s[i]] = torch.exp(pred_e2_scores[i])
+            pred_scores = ops.TopKScores(pred_e2s, torch.exp(pred_e2_scores),
+                                         max(kg.num_entities, kg.num_aug_entities))
         return pred_scores
 
+    def predict_paths(self, mini_batch):
+        """
+        Beam search predictions of a mini-batch with the path that reaches each of them. Requires
+        --save_beam_search_paths.
+
+        :param mini_batch: List of (e1, e2, r) triples. e2 is only used to mask the ground truth edge and may
+            be the dummy entity.
+        :return: List of the (e2, score, path) predictions of each example, in decreasing score order. The
+            score is the probability of the path and the path the list of (r, e) ids traversed, starting with
+            (START_RELATION, e1).
+        """
+        kg, pn = self.kg, self.mdl
+        assert (kg.args.save_beam_search_paths)
+        e1, e2, r = self.format_batch(mini_batch)
+        beam_search_output = search.beam_search(
+            pn, e1, r, e2, kg, self.num_rollout_steps, self.beam_size)
+        pred_e2s = beam_search_output['pred_e2s'].tolist()
+        pred_e2_scores = torch.exp(beam_search_output['pred_e2_scores']).tolist()
+        search_traces = beam_search_output['search_traces']
+        # [len(mini_batch)*output_beam_size, num_steps+1]
+        path_rs = torch.stack([r for r, _ in search_traces], dim=1).tolist()
+        path_es = torch.stack([e for _, e in search_traces], dim=1).tolist()
+        predictions = []
+        for i in range(len(mini_batch)):
+            output_beam_size = len(pred_e2s[i])
+            example_predictions = []
+            for j in range(output_beam_size):
+                if pred_e2s[i][j] == kg.dummy_e:
+                    break
+                ind = i * output_beam_size + j
+                path = list(zip(path_rs[ind], path_es[ind]))
+                example_predictions.append((pred_e2s[i][j], pred_e2_scores[i][j], path))
+            predictions.append(example_predictions)
+        return predictions
+
+    def add_aux_triples(self, triples):
+        """
+        Add aux triples that link unseen entities to the seen entities at inference time, so that the unseen
+        entities can be queried. Must not run concurrently with predict_paths.
+
+        :param triples: List of (e1, e2, r) entity and relation names. The relations must be known.
+        :return: Number of unseen entities added.
+        """
+        kg, pn = self.kg, self.mdl
+        num_entities_added = kg.add_aux_triples(triples)
+        pn.dg.add_aux_triples(triples)
+        assert (len(pn.dg.entity2id) == kg.num_aug_entities)
+        if pn.entity_cache is not None:
+            # the cache is namespaced by graph object and the aux graph was rebuilt
+            pn.entity_cache.clear()
+        return num_entities_added
+
     def record_path_trace(self, path_trace):
         path_length = len(path_trace)
         flattened_path_trace = [x for t in path_trace for x in t]
@@ -15,14 +15,17 @@ import torch.nn.functional as F
 import torch.cuda as cuda
 
 import src.utils.ops as ops
-from src.utils.ops import var_cuda, zeros_var_cuda
+from src.utils.ops import zeros_var_cuda
 
 from src.directed_graph import DirectedGraph
-from src.graph_transformer import GraphTransformer
+from src.graph_transformer import GraphTransformer, EntityRepresentationCache, parameters_version
 import time
 
 device = torch.device("cuda" if cuda.is_available() else "cpu")
 
+# Maximum number of gathered embedding values per chunk of rows in factorized action scoring
+ACTION_SCORING_CHUNK_SIZE = 2 ** 22
+
 class GraphSearchPolicy(nn.Module):
     def __init__(self, args):
         super(GraphSearchPolicy, self).__init__()
@@ -46,11 +49,28 @@ class GraphSearchPolicy(nn.Module):
         self.num_rollout_steps = args.num_rollout_steps
         self.emb_dropout_rate = args.emb_dropout_rate
         self.beam_size = args.beam_size
+        self.dedup_train_entities = args.dedup_train_entities
 
         self.xavier_initialization = args.xavier_initialization
 
         self.relation_only_in_path = args.relation_only_in_path
-        self.path = None
+        # (h, c) LSTM state of the action history of the current paths
+        self.path_state = None
+        # Number of (entity, query) rows and unique pairs encoded by the graph transformer at each step of
+        # the training rollouts and of the eval beam searches, the path initialization being step 0
+        self.num_steps = 0
+        self.dedup_stats = {'train': [], 'eval': []}
+        # Eval-mode entity representations
+        if args.entity_cache_size > 0:
+            if args.eval_neighbor_selection != 'pagerank':
+                # randomly sampled neighbors would be frozen at the first sample of every cached entity
+                raise ValueError('--entity_cache_size requires --eval_neighbor_selection pagerank')
+            self.entity_cache = EntityRepresentationCache(args.entity_cache_size)
+        else:
+            self.entity_cache = None
+        # Action mask invariant checks
+        self.action_mask_validator = ActionMaskValidator(
+            args.action_mask_validation, args.action_mask_validation_period)
 
         # Directed Graph
         self.dg = DirectedGraph(args.data_dir)
@@ -85,7 +105,8 @@ class GraphSearchPolicy(nn.Module):
         :param use_action_space_bucketing: If set, group the action space of different nodes 
             into buckets by their sizes.
         :param merge_aspace_batch_outcome: If set, merge the transition probability distribution
-            generated of different action space bucket into a single batch.
+            generated of different action space bucket into a single batch. The merged action space is
+            an ops.RaggedActionSpace and the merged action distribution a matching flat tensor.
         :return
             With aspace batching and without merging the outcomes:
                 db_outcomes: (Dynamic Batch) (action_space, action_dist)
@@ -99,10 +120,11 @@ class GraphSearchPolicy(nn.Module):
         """
 
         e_s, emb_e_s, q, e_t, first_step, last_step, last_r, seen_nodes = obs
+        self.action_mask_validator.next_step()
 
         # Representation of the current state (current node and other observations)
         Q = self.graph_transformer.dropout(self.graph_transformer.emb_r(q))
-        H = self.path[-1][0][-1, :, :]
+        H = self.path_state[0][-1, :, :]
         if self.relation_only:
             X = torch.cat([H, Q], dim=-1)
         elif self.relation_only_in_path:
@@ -111,9 +133,9 @@ class GraphSearchPolicy(nn.Module):
                 E = emb_e_s
             else:
                 if mode == 'train':
-                    E, _ =  self.graph_transformer(e, q, self.dg.training_graph, self.dg.seen_id2entity, self.bandwidth, mode)
+                    E = self.get_entity_representation(e, q, self.dg.training_graph, mode)
                 else:
-                    E, _ =  self.graph_transformer(e, q, self.dg.eval_graph, self.dg.seen_id2entity, self.bandwidth, mode)
+                    E = self.get_entity_representation(e, q, self.dg.eval_graph, mode)
 
             if E.size()[0] != E_s.size(0):
                 expansion_size = int(E.size()[0]/E_s.size(0))
@@ -125,12 +147,12 @@ class GraphSearchPolicy(nn.Module):
                 E = emb_e_s
             else:
                 if mode == 'train':
-                    E, _ = self.graph_transformer(e, q, self.dg.training_graph, self.dg.seen_id2entity, self.bandwidth, mode)
+                    E = self.get_entity_representation(e, q, self.dg.training_graph, mode)
                 else:
                     if self.args.inference:
-                        E, _ = self.graph_transformer(e, q, self.dg.aux_graph, self.dg.seen_id2entity, self.bandwidth, 'test')
+                        E = self.get_entity_representation(e, q, self.dg.aux_graph, 'test')
                     else:
-                        E, _ = self.graph_transformer(e, q, self.dg.eval_graph, self.dg.seen_id2entity, self.bandwidth, 'eval')
+                        E = self.get_entity_representation(e, q, self.dg.eval_graph, 'eval')
 
             X = torch.cat([E, H, Q], dim=-1)
 
@@ -143,43 +165,29 @@ class GraphSearchPolicy(nn.Module):
 
         def policy_nn_fun(X2, action_space):
             (r_space, e_space), action_mask = action_space
-            A = self.get_action_embedding((r_space, e_space), kg)
-            action_dist = F.softmax(
-                torch.squeeze(A @ torch.unsqueeze(X2, 2), 2) - (1 - action_mask) * ops.HUGE_INT, dim=-1)
+            action_scores = self.get_action_scores(X2, (r_space, e_space), kg)
+            action_dist = F.softmax(action_scores - (1 - action_mask) * ops.HUGE_INT, dim=-1)
             # action_dist = ops.weighted_softmax(torch.squeeze(A @ torch.unsqueeze(X2, 2), 2), action_mask)
             return action_dist, ops.entropy(action_dist)
 
-        def pad_and_cat_action_space(action_spaces, inv_offset):
-            db_r_space, db_e_space, db_action_mask = [], [], []
-            for (r_space, e_space), action_mask in action_spaces:
-                db_r_space.append(r_space)
-                db_e_space.append(e_space)
-                db_action_mask.append(action_mask)
-            r_space = ops.pad_and_cat(db_r_space, padding_value=kg.dummy_r)[inv_offset]
-            e_space = ops.pad_and_cat(db_e_space, padding_value=kg.dummy_e)[inv_offset]
-            action_mask = ops.pad_and_cat(db_action_mask, padding_value=0)[inv_offset]
-            action_space = ((r_space, e_space), action_mask)
-            return action_space
-
         if use_action_space_bucketing:
             db_outcomes = []
             entropy_list = []
-            references = []
             db_action_spaces, db_references = self.get_action_space_in_buckets(e, obs, kg)
             for action_space_b, reference_b in zip(db_action_spaces, db_references):
                 X2_b = X2[reference_b, :]
                 action_dist_b, entropy_b = policy_nn_fun(X2_b, action_space_b)
-                references.extend(reference_b)
                 db_outcomes.append((action_space_b, action_dist_b))
                 entropy_list.append(entropy_b)
-            inv_offset = [i for i, _ in sorted(enumerate(references), key=lambda x: x[1])]
+            # inverse permutation of the bucketed order
+            references = torch.cat(db_references)
+            inv_offset = torch.empty_like(references)
+            inv_offset[references] = torch.arange(len(references), device=references.device)
             entropy = torch.cat(entropy_list, dim=0)[inv_offset]
             if merge_aspace_batching_outcome:
-                db_action_dist = []
-                for _, action_dist in db_outcomes:
-                    db_action_dist.append(action_dist)
-                action_space = pad_and_cat_action_space(db_action_spaces, inv_offset)
-                action_dist = ops.pad_and_cat(db_action_dist, padding_value=0)[inv_offset]
+                db_action_dist = [action_dist for _, action_dist in db_outcomes]
+                action_space, action_dist = ops.RaggedActionSpace.from_buckets(
+                    db_action_spaces, db_action_dist, db_references, len(e))
                 db_outcomes = [(action_space, action_dist)]
                 inv_offset = None
         else:
@@ -189,6 +197,57 @@ class GraphSearchPolicy(nn.Module):
             inv_offset = None
         return db_outcomes, inv_offset, entropy
 
+    def get_entity_representation(self, e, q, graph, mode):
+        """
+        Encode the (entity, query) pairs with the graph transformer. In training mode every row is encoded
+        separately so that it gets its own neighbor samples and neighbor dropout masks, unless
+        --dedup_train_entities is set. Otherwise beams revisit the same entities, so only the unique pairs are
+        encoded and the results are scattered back to the rows. In eval mode the representations of the unique
+        pairs are served from the entity cache if --entity_cache_size is set.
+        :param e: (Variable:batch) entity indices.
+        :param q: (Variable:batch) query relation indices.
+        :param graph: Neighbor graph used by the graph transformer.
+        :param mode: Graph transformer mode ('train', 'eval' or 'test').
+        :return: [batch_size, entity_dim] entity representations.
+        """
+        if mode == 'train' and not self.dedup_train_entities:
+            E, _ = self.graph_transformer(e, q, graph, self.dg.is_seen_entity, self.bandwidth, mode)
+            self.record_dedup_stats(len(e), len(e))
+            return E
+        num_relations = self.graph_transformer.emb_r.num_embeddings
+        unique_pairs, inverse = torch.unique(e * num_relations + q, return_inverse=True)
+
+        def encode(pairs):
+            E, _ = self.graph_transformer(pairs // num_relations, pairs % num_relations, graph,
+                                          self.dg.is_seen_entity, self.bandwidth, mode)
+            return E
+
+        if self.entity_cache is not None and not self.training:
+            E = self.entity_cache.lookup(unique_pairs, (id(graph), mode),
+                                         parameters_version(self.graph_transformer.parameters()), encode)
+        else:
+            E = encode(unique_pairs)
+        self.record_dedup_stats(len(e), len(unique_pairs))
+        return E[inverse]
+
+    def record_dedup_stats(self, num_rows, num_unique_pairs):
+        dedup_stats = self.dedup_stats['train' if self.training else 'eval']
+        while len(dedup_stats) <= self.num_steps:
+            dedup_stats.append([0, 0])
+        dedup_stats[self.num_steps][0] += num_rows
+        dedup_stats[self.num_steps][1] += num_unique_pairs
+
+    def get_dedup_ratios(self, mode='train', reset=True):
+        """
+        :param mode: 'train' for the training rollouts or 'eval' for the beam searches.
+        :return: List of the ratios of unique (entity, query) pairs to graph transformer rows at each step
+            since the last reset.
+        """
+        dedup_ratios = [float(num_unique_pairs) / num_rows for num_rows, num_unique_pairs in self.dedup_stats[mode]]
+        if reset:
+            self.dedup_stats[mode] = []
+        return dedup_ratios
+
     def initialize_path(self, init_action, q, kg, mode):
         '''
         if self.relation_only_in_path:
@@ -197,21 +256,22 @@ class GraphSearchPolicy(nn.Module):
             init_action_embedding = self.get_action_embedding(init_action, kg)
         '''
         emb_e_s = None
+        self.num_steps = 0
 
         if self.relation_only_in_path:
             if mode == 'train':
                 q = q.view(-1, self.num_rollouts)[:, 0]
                 e_s = init_action[1]
                 e_s = e_s.view(-1, self.num_rollouts)[:, 0]
-                emb_e_s, _ = self.graph_transformer(e_s, q, self.dg.training_graph, self.dg.seen_id2entity, self.bandwidth, 'train')
+                emb_e_s = self.get_entity_representation(e_s, q, self.dg.training_graph, 'train')
                 emb_e_s = emb_e_s.unsqueeze(1).expand(-1, self.num_rollouts, -1)
                 emb_e_s = torch.flatten(emb_e_s, start_dim=0).view(-1, self.entity_dim)
             else:
                 e_s = init_action[1]
                 if self.args.inference:
-                    emb_e_s, _ = self.graph_transformer(e_s, q, self.dg.aux_graph, self.dg.seen_id2entity, self.bandwidth, 'test')
+                    emb_e_s = self.get_entity_representation(e_s, q, self.dg.aux_graph, 'test')
                 else:
-                    emb_e_s, _ = self.graph_transformer(e_s, q, self.dg.eval_graph, self.dg.seen_id2entity, self.bandwidth, 'eval')
+                    emb_e_s = self.get_entity_representation(e_s, q, self.dg.eval_graph, 'eval')
 
             emb_r_0 = self.graph_transformer.dropout(self.graph_transformer.emb_r(init_action[0]))
 
@@ -223,15 +283,15 @@ class GraphSearchPolicy(nn.Module):
                 e_s = init_action[1]
                 e_s = e_s.view(-1, self.num_rollouts)[:, 0]
 
-                emb_e_s, _ = self.graph_transformer(e_s, q, self.dg.training_graph, self.dg.seen_id2entity, self.bandwidth, 'train')
+                emb_e_s = self.get_entity_representation(e_s, q, self.dg.training_graph, 'train')
                 emb_e_s = emb_e_s.unsqueeze(1).expand(-1, self.num_rollouts, -1)
                 emb_e_s = torch.flatten(emb_e_s, start_dim=0).view(-1, self.entity_dim)
             else:
                 e_s = init_action[1]
                 if self.args.inference:
-                    emb_e_s, _ = self.graph_transformer(e_s, q, self.dg.aux_graph, self.dg.seen_id2entity, self.bandwidth, 'test')
+                    emb_e_s = self.get_entity_representation(e_s, q, self.dg.aux_graph, 'test')
                 else:
-                    emb_e_s, _ = self.graph_transformer(e_s, q, self.dg.eval_graph, self.dg.seen_id2entity, self.bandwidth, 'eval')
+                    emb_e_s = self.get_entity_representation(e_s, q, self.dg.eval_graph, 'eval')
 
             emb_r_0 = self.graph_transformer.dropout(self.graph_transformer.emb_r(init_action[0]))
 
@@ -240,7 +300,7 @@ class GraphSearchPolicy(nn.Module):
         # [num_layers, batch_size, dim]
         init_h = zeros_var_cuda([self.history_num_layers, len(init_action_embedding), self.history_dim])
         init_c = zeros_var_cuda([self.history_num_layers, len(init_action_embedding), self.history_dim])
-        self.path = [self.path_encoder(init_action_embedding, (init_h, init_c))[1]]
+        self.path_state = self.path_encoder(init_action_embedding, (init_h, init_c))[1]
         return emb_e_s
 
     def update_path(self, action, kg, offset=None):
@@ -252,23 +312,18 @@ class GraphSearchPolicy(nn.Module):
         :param offset: (Variable:batch) if None, adjust path history with the given offset, used for search
         :param KG: Knowledge graph environment.
         """
-        def offset_path_history(p, offset):
-            for i, x in enumerate(p):
-                if type(x) is tuple:
-                    new_tuple = tuple([_x[:, offset, :] for _x in x])
-                    p[i] = new_tuple
-                else:
-                    p[i] = x[offset, :]
-
         # update action history
         if self.relation_only_in_path:
             action_embedding = self.get_action_embedding(action, kg)
         else:
             action_embedding = self.get_action_embedding(action, kg)
+        # only the last LSTM state is read by later steps, so it is the only one reordered and kept
+        h, c = self.path_state
         if offset is not None:
-            offset_path_history(self.path, offset)
+            h, c = h[:, offset, :], c[:, offset, :]
 
-        self.path.append(self.path_encoder(action_embedding.unsqueeze(1), self.path[-1])[1])
+        self.path_state = self.path_encoder(action_embedding.unsqueeze(1), (h, c))[1]
+        self.num_steps += 1
 
     def get_action_space_in_buckets(self, e, obs, kg, collapse_entities=False):
         """
@@ -315,21 +370,30 @@ class GraphSearchPolicy(nn.Module):
         if collapse_entities:
             raise NotImplementedError
         else:
-            entity2bucketid = kg.entity2bucketid[e.tolist()]
-            key1 = entity2bucketid[:, 0]
-            key2 = entity2bucketid[:, 1]
-            batch_ref = {}
-            for i in range(len(e)):
-                key = int(key1[i])
-                if not key in batch_ref:
-                    batch_ref[key] = []
-                batch_ref[key].append(i)
-            for key in batch_ref:
+            # Group the examples by bucket with the buckets in order of their first example in the batch
+            # and the examples of each bucket in batch order
+            key1 = kg.entity2bucketid[e, 0]
+            key2 = kg.entity2bucketid[e, 1]
+            batch_size = len(e)
+            position = torch.arange(batch_size, device=e.device)
+            bucket_sizes = torch.zeros(kg.num_bucket_keys, dtype=torch.long, device=e.device)
+            bucket_sizes = bucket_sizes.index_add(0, key1, torch.ones_like(key1))
+            first_position = torch.full((kg.num_bucket_keys,), batch_size, dtype=torch.long, device=e.device)
+            first_position = first_position.scatter_reduce(0, key1, position, 'amin')
+            bucket_order = torch.argsort(first_position)
+            bucket_rank = torch.empty_like(bucket_order)
+            bucket_rank[bucket_order] = torch.arange(kg.num_bucket_keys, device=e.device)
+            order = torch.argsort(bucket_rank[key1] * batch_size + position)
+            # the only host synchronization: keys and sizes of the non-empty buckets
+            bucket_keys, bucket_sizes = torch.stack([bucket_order, bucket_sizes[bucket_order]]).tolist()
+            num_buckets = sum(1 for size in bucket_sizes if size > 0)
+            batch_ref = zip(bucket_keys[:num_buckets],
+                            torch.split(order, bucket_sizes[:num_buckets]))
+            for key, l_batch_refs in batch_ref:
                 action_space = kg.action_space_buckets[key]
                 # l_batch_refs: ids of the examples in the current batch of examples
                 # g_bucket_ids: ids of the examples in the corresponding KG action space bucket
-                l_batch_refs = batch_ref[key]
-                g_bucket_ids = key2[l_batch_refs].tolist()
+                g_bucket_ids = key2[l_batch_refs]
                 r_space_b = action_space[0][0][g_bucket_ids]
                 e_space_b = action_space[0][1][g_bucket_ids]
                 action_mask_b = action_space[1][g_bucket_ids]
@@ -359,13 +423,13 @@ class GraphSearchPolicy(nn.Module):
         # Prevent the agent from selecting the ground truth edge
         ground_truth_edge_mask = self.get_ground_truth_edge_mask(e, r_space, e_space, e_s, q, e_t, kg)
         action_mask -= ground_truth_edge_mask
-        self.validate_action_mask(action_mask)
+        self.action_mask_validator.check(action_mask)
 
         # Mask out false negatives in the final step
         if last_step:
             false_negative_mask = self.get_false_negative_mask(e_space, e_s, q, e_t, kg)
             action_mask *= (1 - false_negative_mask)
-            self.validate_action_mask(action_mask)
+            self.action_mask_validator.check(action_mask)
 
         # Prevent the agent from stopping in the middle of a path
         # stop_mask = (last_r == NO_OP_RELATION_ID).unsqueeze(1).float()
@@ -388,19 +452,10 @@ class GraphSearchPolicy(nn.Module):
 
     def get_answer_mask(self, e_space, e_s, q, kg):
         if kg.args.mask_test_false_negatives:
-            answer_vectors = kg.all_object_vectors
+            answer_index = kg.all_objects
         else:
-            answer_vectors = kg.train_object_vectors
-        answer_masks = []
-        for i in range(len(e_space)):
-            _e_s, _q = int(e_s[i]), int(q[i])
-            if not _e_s in answer_vectors or not _q in answer_vectors[_e_s]:
-                answer_vector = var_cuda(torch.LongTensor([[kg.num_entities]]))
-            else:
-                answer_vector = answer_vectors[_e_s][_q]
-            answer_mask = torch.sum(e_space[i].unsqueeze(0) == answer_vector, dim=0).long()
-            answer_masks.append(answer_mask)
-        answer_mask = torch.cat(answer_masks).view(len(e_space), -1)
+            answer_index = kg.train_objects
+        answer_mask = answer_index.contains(e_s, q, e_space).long()
         return answer_mask
 
     def get_false_negative_mask(self, e_space, e_s, q, e_t, kg):
@@ -418,11 +473,70 @@ class GraphSearchPolicy(nn.Module):
         false_negative_mask = (answer_mask * (e_space != e_t.unsqueeze(1)).long()).float()
         return false_negative_mask
 
-    def validate_action_mask(self, action_mask):
-        action_mask_min = action_mask.min()
-        action_mask_max = action_mask.max()
-        assert (action_mask_min == 0 or action_mask_min == 1)
-        assert (action_mask_max == 0 or action_mask_max == 1)
+    def get_action_scores(self, X2, action_space, kg):
+        """
+        Return the [batch, action_space_size] dot products of the action embeddings and the projected state.
+        The action embedding is the concatenation [emb_r; emb_e], so the score is the sum of a relation term
+        and an entity term, each computed without creating the [batch, action_space_size, action_dim] action
+        embeddings:
+            - from a [batch, table_size] table of the scores of the relations (or of the unique entities of
+              the batch) gathered per action, if the table is no wider than the action space;
+            - otherwise from the embeddings of each row's own actions, over chunks of rows
+              (see get_row_action_scores).
+
+        The embedding dropout is sampled per action, so the factorized scores are used only when the dropout
+        is inactive (eval mode or a zero rate) and --dense_action_scoring is not set.
+
+        :param X2: [batch, action_dim] projected state.
+        :param action_space (r_space, e_space): [batch, action_space_size] action indices.
+        :param kg: Knowledge graph enviroment.
+        """
+        r_space, e_space = action_space
+        if self.args.dense_action_scoring or \
+                (self.training and self.graph_transformer.dropout.p > 0):
+            A = self.get_action_embedding((r_space, e_space), kg)
+            return torch.squeeze(A @ torch.unsqueeze(X2, 2), 2)
+
+        emb_r, emb_e = self.graph_transformer.emb_r, self.graph_transformer.emb_e
+        action_space_size = r_space.size(1)
+        X2_r, X2_e = X2[:, :emb_r.embedding_dim], X2[:, emb_r.embedding_dim:]
+        if emb_r.num_embeddings <= action_space_size:
+            # [batch, num_relations]
+            relation_scores = X2_r @ emb_r.weight.t()
+            action_scores = torch.gather(relation_scores, 1, r_space)
+        else:
+            action_scores = self.get_row_action_scores(X2_r, r_space, emb_r)
+        if not self.relation_only:
+            # unseen entities have no embedding of their own
+            e_space = e_space.masked_fill(e_space >= kg.num_entities, 0)
+            unique_e, e_space_ind = torch.unique(e_space, return_inverse=True)
+            if len(unique_e) <= action_space_size:
+                # [batch, num_unique_entities]
+                entity_scores = X2_e @ emb_e(unique_e).t()
+                action_scores = action_scores + torch.gather(entity_scores, 1, e_space_ind)
+            else:
+                action_scores = action_scores + self.get_row_action_scores(X2_e, e_space, emb_e)
+        return action_scores
+
+    def get_row_action_scores(self, X, action_ids, embedding):
+        """
+        Return the [batch, action_space_size] dot products of each row of X with the embeddings of its own
+        actions. The rows are processed in chunks holding at most ACTION_SCORING_CHUNK_SIZE gathered embedding
+        values.
+
+        :param X: [batch, dim] projected state.
+        :param action_ids: [batch, action_space_size] relation or entity indices.
+        :param embedding: nn.Embedding of the indices.
+        """
+        num_rows, action_space_size = action_ids.size()
+        if num_rows == 0:
+            return X.new_zeros(0, action_space_size)
+        chunk_size = max(ACTION_SCORING_CHUNK_SIZE // max(action_space_size * embedding.embedding_dim, 1), 1)
+        action_scores = []
+        for i in range(0, num_rows, chunk_size):
+            A = embedding(action_ids[i:i + chunk_size])
+            action_scores.append(torch.squeeze(A @ torch.unsqueeze(X[i:i + chunk_size], 2), 2))
+        return torch.cat(action_scores, dim=0)
 
     def get_action_embedding(self, action, kg):
         """
@@ -436,8 +550,8 @@ class GraphSearchPolicy(nn.Module):
         :param kg: Knowledge graph enviroment.
         """
         r, e = action
-        for i in range(e.size()[0]):
-            e[i][e[i] >= kg.num_entities] = 0
+        # unseen entities have no embedding of their own
+        e = e.masked_fill(e >= kg.num_entities, 0)
 
         relation_embedding = self.graph_transformer.dropout(self.graph_transformer.emb_r(r))
         if self.relation_only:
@@ -454,7 +568,10 @@ class GraphSearchPolicy(nn.Module):
                                                   dropout=self.emb_dropout_rate,\
                                                   embed_dim=self.entity_dim, \
                                                   hidden_dim=self.hidden_dim, \
-                                                  neighbor_dropout_rate=self.action_dropout_rate)
+                                                  neighbor_dropout_rate=self.action_dropout_rate, \
+                                                  eval_neighbor_selection=self.args.eval_neighbor_selection, \
+                                                  padded_neighbor_attention=self.args.padded_neighbor_attention, \
+                                                  record_attention_stats=self.args.run_analysis)
 
         self.graph_transformer = self.graph_transformer.cuda()
 
@@ -491,3 +608,57 @@ class GraphSearchPolicy(nn.Module):
 
             # Intitialize the parameters of Graph Transformer
             self.graph_transformer.initialize_modules()
+
+
+class ActionMaskValidator():
+    """
+    Checks that the action masks only contain 0s and 1s.
+        - off: no checks.
+        - sampled: check the masks of 1 in `period` transition steps and count the violations on the device,
+            so the checks never wait on the GPU.
+        - strict: check every mask and fail on the first violation.
+    """
+    def __init__(self, mode='off', period=100):
+        assert (mode in ['off', 'sampled', 'strict'])
+        self.mode = mode
+        self.period = period
+        self.num_steps = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_checks = 0
+        self.num_violations = 0
+
+    def next_step(self):
+        self.num_steps += 1
+
+    def check(self, action_mask):
+        """
+        :param action_mask: [batch_size, action_space_size] action mask.
+        """
+        if self.mode == 'strict':
+            action_mask_min = action_mask.min()
+            action_mask_max = action_mask.max()
+            assert (action_mask_min == 0 or action_mask_min == 1)
+            assert (action_mask_max == 0 or action_mask_max == 1)
+            self.num_checks += 1
+        elif self.mode == 'sampled' and self.num_steps % self.period == 0:
+            is_valid = (action_mask == 0) | (action_mask == 1)
+            self.num_violations = self.num_violations + (~is_valid).any(dim=1).long().sum()
+            self.num_checks += 1
+
+    def get_stats(self, reset=True):
+        """
+        :return: Number of masks checked and number of mask rows with values other than 0 and 1.
+        """
+        stats = self.num_checks, int(self.num_violations)
+        if reset:
+            self.reset_stats()
+        return stats
+
+    def print_stats(self, reset=True):
+        if self.mode == 'off':
+            return
+        num_checks, num_violations = self.get_stats(reset=reset)
+        print('Action mask validation ({}): {} masks checked, {} invalid rows'.format(
+            self.mode, num_checks, num_violations))
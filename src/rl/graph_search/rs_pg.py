@@ -15,7 +15,6 @@ from src.emb.fact_network import get_conve_nn_state_dict, get_conve_kg_state_dic
     get_complex_kg_state_dict, get_distmult_kg_state_dict
 from src.rl.graph_search.pg import PolicyGradient
 import src.utils.ops as ops
-from src.utils.ops import zeros_var_cuda
 
 
 class RewardShapingPolicyGradient(PolicyGradient):
@@ -98,13 +97,8 @@ class RewardShapingPolicyGradient(PolicyGradient):
         return self.model.split('.')[2]
 
 def forward_fact_oracle(e1, r, e2, kg):
-    oracle = zeros_var_cuda([len(e1), kg.num_entities]).cuda()
-    for i in range(len(e1)):
-        _e1, _r = int(e1[i]), int(r[i])
-        if _e1 in kg.all_object_vectors and _r in kg.all_object_vectors[_e1]:
-            answer_vector = kg.all_object_vectors[_e1][_r]
-            oracle[i][answer_vector] = 1
-        else:
-            raise ValueError('Query answer not found')
-    oracle_e2 = ops.batch_lookup(oracle, e2.unsqueeze(1))
+    answers, answer_mask = kg.all_objects.answers_of(e1, r)
+    if not bool(answer_mask[:, 0].all()):
+        raise ValueError('Query answer not found')
+    oracle_e2 = torch.sum(answers == e2.unsqueeze(1), dim=1).float()
     return oracle_e2
@@ -0,0 +1,308 @@
+"""
+ Link prediction server.
+
+ Answers (e1, r) queries with the beam search predictions of a trained graph search policy and the path that
+ reaches each of them. Concurrent requests are grouped into mini-batches: a batch is run once it holds
+ --serve_batch_size queries or --serve_max_latency milliseconds after its first query arrived, whichever
+ comes first. The model runs in the thread that calls run_server, the HTTP requests are handled in background
+ threads.
+
+ POST /predict
+    {"queries": [{"e1": "<entity name>", "r": "<relation name>"}, ...], "top_k": 10}
+ =>
+    {"results": [{"e1": ..., "r": ..., "predictions": [{"e2": ..., "score": ..., "path": ...}, ...]}, ...]}
+ POST /load
+    {"triples": [{"e1": "<entity name>", "e2": "<entity name>", "r": "<relation name>"}, ...]}
+ =>
+    {"num_entities_added": ...}
+    Adds aux triples linking unseen entities to the seen entities, so that the unseen entities can be queried.
+    The triples are loaded in the model thread between two mini-batches and are not saved to aux.triples.
+ GET /health
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn, TCPServer, UnixStreamServer
+
+import torch
+
+import src.utils.ops as ops
+
+
+class QueryError(Exception):
+    pass
+
+
+class PendingRequest():
+    """
+    Queries of an HTTP request waiting for their predictions, or aux triples waiting to be loaded.
+    """
+    def __init__(self, queries, triples=None):
+        self.queries = queries
+        self.triples = triples
+        self.predictions = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class QueryBatcher():
+    """
+    Groups the queries of concurrent requests into mini-batches and runs them through the model.
+    """
+    def __init__(self, lf, batch_size, max_latency):
+        """
+        :param lf: PolicyGradient model in eval mode.
+        :param batch_size: Maximum number of queries in a mini-batch.
+        :param max_latency: Maximum number of seconds the first query of a mini-batch waits for more queries.
+        """
+        self.lf = lf
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+        # load request received while a mini-batch was being filled
+        self.next_request = None
+
+    def submit(self, queries):
+        """
+        Queue the (e1, r) queries and wait for their predictions.
+        :return: List of the (e2, score, path) predictions of each query.
+        """
+        return self.wait(PendingRequest(queries))
+
+    def load(self, triples):
+        """
+        Queue the (e1, e2, r) aux triples and wait until they are loaded.
+        :return: Number of unseen entities added.
+        """
+        return self.wait(PendingRequest([], triples=triples))
+
+    def wait(self, request):
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.predictions
+
+    def next_batch(self):
+        """
+        :return: The requests of the next mini-batch. A request that has more queries than the batch size
+            fills a mini-batch by itself, and so does a load request.
+        """
+        if self.next_request is not None:
+            batch, self.next_request = [self.next_request], None
+        else:
+            batch = [self.requests.get()]
+        if batch[0].triples is not None:
+            return batch
+        num_queries = len(batch[0].queries)
+        deadline = time.time() + self.max_latency
+        while num_queries < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request.triples is not None:
+                # run after the queries received before it
+                self.next_request = request
+                break
+            batch.append(request)
+            num_queries += len(request.queries)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch[0].triples is not None:
+                self.run_load(batch[0])
+            else:
+                self.run_batch(batch)
+
+    def run_load(self, request):
+        try:
+            with torch.no_grad():
+                request.predictions = self.lf.add_aux_triples(request.triples)
+        except Exception as e:
+            request.error = e
+        request.done.set()
+
+    def run_batch(self, batch):
+        dummy_e = self.lf.kg.dummy_e
+        examples = [(e1, dummy_e, r) for request in batch for e1, r in request.queries]
+        try:
+            predictions = []
+            with torch.no_grad():
+                for example_id in range(0, len(examples), self.batch_size):
+                    predictions += self.lf.predict_paths(examples[example_id:example_id + self.batch_size])
+        except Exception as e:
+            for request in batch:
+                request.error = e
+                request.done.set()
+            return
+        offset = 0
+        for request in batch:
+            request.predictions = predictions[offset:offset + len(request.queries)]
+            offset += len(request.queries)
+            request.done.set()
+
+class LinkPredictionHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path == '/predict':
+            self.predict()
+        elif self.path == '/load':
+            self.load()
+        else:
+            self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+
+    def read_json(self):
+        return json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+    def predict(self):
+        try:
+            request = self.read_json()
+            queries = self.parse_queries(request)
+            top_k = int(request.get('top_k', self.server.lf.beam_size))
+            if top_k < 1:
+                raise QueryError('top_k must be a positive integer: {}'.format(top_k))
+        except (QueryError, ValueError, TypeError, KeyError, AttributeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        if not queries:
+            self.send_json(200, {'results': []})
+            return
+        try:
+            predictions = self.server.batcher.submit(queries)
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        results = []
+        for query, query_predictions in zip(request['queries'], predictions):
+            results.append({
+                'e1': query['e1'],
+                'r': query['r'],
+                'predictions': [self.format_prediction(e2, score, path)
+                                for e2, score, path in query_predictions[:top_k]]
+            })
+        self.send_json(200, {'results': results})
+
+    def load(self):
+        try:
+            triples = self.parse_triples(self.read_json())
+        except (QueryError, ValueError, TypeError, KeyError, AttributeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        if not triples:
+            self.send_json(200, {'num_entities_added': 0})
+            return
+        try:
+            num_entities_added = self.server.batcher.load(triples)
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        self.send_json(200, {'num_entities_added': num_entities_added})
+
+    def parse_queries(self, request):
+        """
+        :return: List of the (e1, r) ids of the queries of a request. Unseen entities are looked up in the
+            index of the aux graph.
+        """
+        kg = self.server.lf.kg
+        queries = []
+        for query in request['queries']:
+            if not query['e1'] in kg.entity2id_aug:
+                raise QueryError('unknown entity: {}'.format(query['e1']))
+            if not query['r'] in kg.relation2id:
+                raise QueryError('unknown relation: {}'.format(query['r']))
+            queries.append((kg.entity2id_aug[query['e1']], kg.relation2id[query['r']]))
+        return queries
+
+    def parse_triples(self, request):
+        """
+        :return: List of the (e1, e2, r) names of the aux triples of a load request.
+        """
+        kg = self.server.lf.kg
+        triples = []
+        for triple in request['triples']:
+            for e in (triple['e1'], triple['e2']):
+                if not isinstance(e, str) or not e or len(e.split()) != 1:
+                    raise QueryError('invalid entity name: {}'.format(e))
+            if not triple['r'] in kg.relation2id:
+                raise QueryError('unknown relation: {}'.format(triple['r']))
+            triples.append((triple['e1'], triple['e2'], triple['r']))
+        return triples
+
+    def format_prediction(self, e2, score, path):
+        kg = self.server.lf.kg
+        return {
+            'e2': kg.id2entity[e2] if e2 in kg.id2entity else kg.id2entity_aug[e2],
+            'score': score,
+            'path': ops.format_path(path, kg)
+        }
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return super(LinkPredictionHandler, self).address_string()
+        return self.server.server_address
+
+
+class ThreadingHTTPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def run_server(lf, args):
+    """
+    Serve link prediction queries until interrupted.
+
+    :param lf: PolicyGradient model in eval mode, built with --inference and --save_beam_search_paths.
+    :param args: Server options (--serve_host, --serve_port, --serve_socket, --serve_batch_size and
+        --serve_max_latency).
+    """
+    if args.serve_socket:
+        if os.path.exists(args.serve_socket):
+            os.remove(args.serve_socket)
+        server = ThreadingUnixHTTPServer(args.serve_socket, LinkPredictionHandler)
+        address = args.serve_socket
+    else:
+        server = ThreadingHTTPServer((args.serve_host, args.serve_port), LinkPredictionHandler)
+        address = 'http://{}:{}'.format(args.serve_host, args.serve_port)
+    server.lf = lf
+    server.batcher = QueryBatcher(lf, args.serve_batch_size, args.serve_max_latency / 1000.0)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    print('Serving link prediction queries at {}'.format(address))
+    try:
+        server.batcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        if args.serve_socket and os.path.exists(args.serve_socket):
+            os.remove(args.serve_socket)
@@ -17,6 +17,98 @@ EPSILON = float(np.finfo(float).eps)
 HUGE_INT = 1e31
 
 
+class TopKScores():
+    """
+    Sparse prediction scores: the scores of the top-k predicted entities of each example. The scores of
+    all other entities are 0. Rows are padded with index 0 and score 0.
+    """
+    def __init__(self, indices, scores, num_entities):
+        """
+        :param indices: [batch_size, k] predicted entity indices.
+        :param scores: [batch_size, k] scores of the predicted entities.
+        :param num_entities: number of entities of the dense score matrix.
+        """
+        self.indices = indices
+        self.scores = scores
+        self.num_entities = num_entities
+
+    def __len__(self):
+        return self.indices.size(0)
+
+    def __getitem__(self, idx):
+        return TopKScores(self.indices[idx], self.scores[idx], self.num_entities)
+
+    @property
+    def shape(self):
+        return torch.Size([len(self), self.num_entities])
+
+    def to_dense(self):
+        dense_scores = self.scores.new_zeros(len(self), self.num_entities)
+        dense_scores.scatter_(1, self.indices, self.scores)
+        return dense_scores
+
+    @staticmethod
+    def cat(topk_scores_list):
+        return TopKScores(pad_and_cat([x.indices for x in topk_scores_list], padding_value=0),
+                          pad_and_cat([x.scores for x in topk_scores_list], padding_value=0),
+                          max(x.num_entities for x in topk_scores_list))
+
+
+class RaggedActionSpace():
+    """
+    Action spaces of a batch packed into flat tensors: the actions of row i are r_space[j], e_space[j],
+    action_mask[j] for offsets[i] <= j < offsets[i + 1]. Each row keeps the width of its action space
+    bucket, so no row is padded to the widest bucket of the batch.
+    """
+    def __init__(self, r_space, e_space, action_mask, row_ids, offsets, max_width):
+        """
+        :param r_space, e_space, action_mask: [num_actions] packed action relations, entities and masks.
+        :param row_ids: [num_actions] row of each action.
+        :param offsets: [num_rows + 1] start of each row in the packed tensors.
+        :param max_width: maximum number of actions of a row.
+        """
+        self.r_space = r_space
+        self.e_space = e_space
+        self.action_mask = action_mask
+        self.row_ids = row_ids
+        self.offsets = offsets
+        self.max_width = max_width
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @staticmethod
+    def from_buckets(action_spaces, action_dists, references, num_rows):
+        """
+        Pack the action spaces and action distributions of action space buckets in the original row order.
+        :param action_spaces: List of ((r_space, e_space), action_mask) [bucket_size, bucket_width] buckets.
+        :param action_dists: List of [bucket_size, bucket_width] action distributions.
+        :param references: List of (Variable:bucket_size) rows of the bucket examples in the batch.
+        :param num_rows: Batch size.
+        :return: RaggedActionSpace, [num_actions] packed action distribution.
+        """
+        max_width = max(action_mask.size(1) for _, action_mask in action_spaces)
+        r_spaces, e_spaces, action_masks, dists, row_ids, columns = [], [], [], [], [], []
+        for ((r_space, e_space), action_mask), action_dist, reference in \
+                zip(action_spaces, action_dists, references):
+            bucket_size, bucket_width = action_mask.size()
+            r_spaces.append(r_space.reshape(-1))
+            e_spaces.append(e_space.reshape(-1))
+            action_masks.append(action_mask.reshape(-1))
+            dists.append(action_dist.reshape(-1))
+            row_ids.append(reference.unsqueeze(1).expand(bucket_size, bucket_width).reshape(-1))
+            columns.append(torch.arange(bucket_width, device=reference.device).repeat(bucket_size))
+        row_ids = torch.cat(row_ids)
+        order = torch.argsort(row_ids * max_width + torch.cat(columns))
+        row_ids = row_ids[order]
+        row_sizes = torch.zeros(num_rows, dtype=torch.long, device=row_ids.device)
+        row_sizes = row_sizes.index_add(0, row_ids, torch.ones_like(row_ids))
+        offsets = torch.cat([row_sizes.new_zeros(1), torch.cumsum(row_sizes, dim=0)])
+        action_space = RaggedActionSpace(torch.cat(r_spaces)[order], torch.cat(e_spaces)[order],
+                                         torch.cat(action_masks)[order], row_ids, offsets, max_width)
+        return action_space, torch.cat(dists)[order]
+
+
 def batch_lookup(M, idx, vector_output=True):
     """
     Perform batch lookup on matrix M using indices idx.
@@ -145,6 +237,27 @@ def rearrange_vector_list(l, offset):
     for i, v in enumerate(l):
         l[i] = v[offset]
 
+def backtrack_beam_trace(trace, offsets):
+    """
+    Align a search trace stored as back-pointers with the beams of its last step.
+
+    :param trace: List of (Variable:beam) tensors or tuples of tensors, trace[t] holding a value per beam
+        of step t.
+    :param offsets: List of (Variable:beam) back-pointers, offsets[t] holding the index of the parent beam
+        in step t-1 of each beam of step t. offsets[0] is ignored.
+    :return: trace[t] re-indexed by the step t ancestor of each last step beam.
+    """
+    ind = None
+    aligned_trace = []
+    for t in range(len(trace) - 1, -1, -1):
+        x = trace[t]
+        if ind is not None:
+            x = tuple([_x[ind] for _x in x]) if type(x) is tuple else x[ind]
+        aligned_trace.append(x)
+        if t > 0:
+            ind = offsets[t] if ind is None else offsets[t][ind]
+    return aligned_trace[::-1]
+
 def safe_log(x):
     return torch.log(x + EPSILON)
 
@@ -190,20 +303,81 @@ def pack(l, a):
             l.pop(0)
 
 
-def unique_max(unique_x, x, values, marker_2D=None):
-    unique_interval = 100
-    unique_values, unique_indices = [], []
-    # prevent memory explotion during decoding
-    for i in range(0, len(unique_x), unique_interval):
-        unique_x_b = unique_x[i:i+unique_interval]
-        marker_2D = (unique_x_b.unsqueeze(1) == x.unsqueeze(0)).float()
-        values_2D = marker_2D * values.unsqueeze(0) - (1 - marker_2D) * HUGE_INT
-        unique_values_b, unique_idx_b = values_2D.max(dim=1)
-        unique_values.append(unique_values_b)
-        unique_indices.append(unique_idx_b)
-    unique_values = torch.cat(unique_values)
-    unique_idx = torch.cat(unique_indices)
-    return unique_values, unique_idx
+def segment_softmax(values, segment_ids, num_segments):
+    """
+    Softmax over the entries of each segment.
+
+    :param values: [n, ...] values.
+    :param segment_ids: [n] segment index of each entry in [0, num_segments).
+    :param num_segments: number of segments.
+    :return: [n, ...] values normalized within each segment (along the first dimension).
+    """
+    index = segment_ids.view(-1, *([1] * (values.dim() - 1))).expand_as(values)
+    segment_max = values.new_full((num_segments,) + values.size()[1:], -float('inf'))
+    segment_max = segment_max.scatter_reduce(0, index, values.detach(), 'amax', include_self=False)
+    exp_values = torch.exp(values - segment_max[segment_ids])
+    segment_sum = values.new_zeros((num_segments,) + values.size()[1:]).index_add(0, segment_ids, exp_values)
+    return exp_values / segment_sum[segment_ids]
+
+def segment_top_k(values, segment_ids, num_segments, k):
+    """
+    Select the k largest values of each segment of a flat tensor.
+
+    :param values: [n] values.
+    :param segment_ids: [n] segment index of each value in [0, num_segments).
+    :param num_segments: number of segments.
+    :param k: number of values selected per segment.
+    :return top_values: [num_segments, k] selected values of each segment in decreasing order, padded with -HUGE_INT.
+    :return top_idx: [num_segments, k] position of each selected value in values, padded with 0.
+    :return mask: [num_segments, k] binary mask indicating the valid entries.
+    """
+    n = len(values)
+    # Sort by decreasing value, then (stably) by segment
+    order = torch.argsort(values, descending=True)
+    sorted_segment_ids, segment_order = torch.sort(segment_ids[order], stable=True)
+    order = order[segment_order]
+    segment_sizes = torch.zeros(num_segments, dtype=torch.long, device=values.device)
+    segment_sizes = segment_sizes.index_add(0, segment_ids, torch.ones_like(segment_ids))
+    segment_starts = torch.cumsum(segment_sizes, dim=0) - segment_sizes
+    rank = torch.arange(n, device=values.device) - segment_starts[sorted_segment_ids]
+    # entries beyond the k-th of their segment are written to an extra slot that is dropped
+    target = torch.where(rank < k, sorted_segment_ids * k + rank, torch.full_like(rank, num_segments * k))
+    top_values = values.new_full((num_segments * k + 1,), -HUGE_INT).scatter(0, target, values[order])
+    top_idx = order.new_zeros(num_segments * k + 1).scatter(0, target, order)
+    mask = torch.zeros(num_segments * k + 1, dtype=torch.bool, device=values.device)
+    mask = mask.scatter(0, target, torch.ones_like(target, dtype=torch.bool))
+    return top_values[:-1].view(num_segments, k), top_idx[:-1].view(num_segments, k), mask[:-1].view(num_segments, k)
+
+def segment_unique_top_k(values, keys, segment_ids, num_segments, k, num_keys):
+    """
+    For each segment, take the maximum value of every distinct key and select the k largest of these maxima.
+
+    :param values: [n] values.
+    :param keys: [n] integer keys in [0, num_keys).
+    :param segment_ids: [n] segment index of each value in [0, num_segments).
+    :param num_segments: number of segments.
+    :param k: maximum number of distinct keys selected per segment.
+    :param num_keys: upper bound of the keys.
+    :return: top_values, top_idx, mask as returned by segment_top_k.
+    """
+    n = len(values)
+    if n == 0:
+        return segment_top_k(values, segment_ids, num_segments, k)
+    # Sort by decreasing value, then (stably) by (segment, key): the first entry of every (segment, key) group
+    # is its maximum
+    order = torch.argsort(values, descending=True)
+    group_keys, group_order = torch.sort((segment_ids * num_keys + keys)[order], stable=True)
+    order = order[group_order]
+    is_first = torch.ones(n, dtype=torch.bool, device=values.device)
+    is_first[1:] = group_keys[1:] != group_keys[:-1]
+    is_max = torch.zeros(n, dtype=torch.bool, device=values.device)
+    is_max[order] = is_first
+    top_values, top_idx, mask = segment_top_k(values.masked_fill(~is_max, -float('inf')), segment_ids,
+                                              num_segments, k)
+    mask = mask & is_max[top_idx]
+    top_values = top_values.masked_fill(~mask, -HUGE_INT)
+    top_idx = top_idx.masked_fill(~mask, 0)
+    return top_values, top_idx, mask
 
 
 if __name__ == '__main__':